@@ -0,0 +1,115 @@
+'''
+Load tests the query service on localhost and reports throughput and latency percentiles as JSON.
+By default a service is started in this process on a synthetic corpus:
+
+    python benchmarks/load_test.py --n-docs 2000 --clients 16 --queries-per-client 200
+
+or an already running service (python service.py ...) is targeted with --address host:port, in
+which case doc ids are drawn from range(--n-docs) and external documents from the synthetic corpus.
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+from collections import OrderedDict
+from timeit import default_timer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from csg import CommonSequenceGenerator
+from normalizers import FusedBasicNormalizer
+from service import QueryService, QueryServer, QueryClient, LatencyTracker
+from shingle_table import ShingleTable
+from shingler import Shingler
+from stats import Stats
+from synthetic_corpus import SyntheticCorpus
+
+
+def run_load_test(address, corpus, n_clients = 8, queries_per_client = 100, external_rate = 0.2, seed = 0):
+    '''
+    Runs n_clients threads, each with its own connection sending queries_per_client queries back to
+    back: generate_common_sequences for a random document of the corpus, or, with probability
+    external_rate, find_common_sequences for the text of one. Returns client side throughput and
+    latency percentiles, and the service's own metrics.
+    '''
+    latencies = LatencyTracker(window = n_clients * queries_per_client)
+    errors = []
+
+    def client(client_index):
+        rnd = random.Random(seed + client_index)
+        with QueryClient(address) as query_client:
+            for _ in xrange(queries_per_client):
+                doc_id = rnd.randrange(len(corpus))
+                start = default_timer()
+                try:
+                    if rnd.random() < external_rate:
+                        query_client.query(doc = corpus.doc_record(doc_id).doc)
+                    else:
+                        query_client.query(doc_id = doc_id)
+                except ValueError as e:
+                    errors.append(str(e))
+                latencies.record(default_timer() - start)
+
+    threads = [threading.Thread(target = client, args = (client_index,)) for client_index in xrange(n_clients)]
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = default_timer() - start
+
+    with QueryClient(address) as query_client:
+        service_metrics = query_client.metrics()
+
+    n_queries = n_clients * queries_per_client
+    return OrderedDict([('n_queries', n_queries), ('n_errors', len(errors)), ('seconds', seconds),
+                        ('queries_per_second', n_queries / seconds), ('client_latency', latencies.summary()),
+                        ('service', service_metrics)])
+
+def _parse_args():
+
+    parser = argparse.ArgumentParser(description = 'Load test the common sequence query service.')
+    parser.add_argument('--address', help = 'host:port of a running service (default: start one in process)')
+    parser.add_argument('--n-docs', type = int, default = 1000)
+    parser.add_argument('--doc-length', type = int, default = 500, help = 'tokens per document')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--shingle-size', type = int, default = 8)
+    parser.add_argument('--clients', type = int, default = 8)
+    parser.add_argument('--queries-per-client', type = int, default = 100)
+    parser.add_argument('--external-rate', type = float, default = 0.2, help = 'fraction of queries sending a document text')
+    parser.add_argument('--processes', type = int, default = None)
+    parser.add_argument('--max-batch-size', type = int, default = 16)
+    parser.add_argument('--batch-window-ms', type = float, default = 2.0)
+    return parser.parse_args()
+
+def main():
+
+    args = _parse_args()
+    corpus = SyntheticCorpus(n_docs = args.n_docs, doc_length = args.doc_length, seed = args.seed)
+    run = lambda address: run_load_test(address, corpus, n_clients = args.clients, queries_per_client = args.queries_per_client,
+                                        external_rate = args.external_rate, seed = args.seed)
+    if args.address:
+        host, port = args.address.rsplit(':', 1)
+        report = run((host, int(port)))
+    else:
+        shingler = Shingler(args.shingle_size, FusedBasicNormalizer().normalize)
+        generator = CommonSequenceGenerator(ShingleTable(shingler.shingle_docs(corpus), shingler = shingler))
+        with QueryService(generator, processes = args.processes, max_batch_size = args.max_batch_size,
+                          batch_window = args.batch_window_ms / 1000.0, stats = Stats()) as query_service:
+            server = QueryServer(query_service, ('127.0.0.1', 0))
+            server_thread = threading.Thread(target = server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+            try:
+                report = run(server.server_address)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    json.dump(OrderedDict([('config', vars(args)), ('results', report)]), sys.stdout, indent = 2)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+'''
+Times every stage of the common sequence pipeline on a synthetic corpus and writes the results 
+as JSON, to compare commits or size hardware:
+
+    python benchmarks/run_benchmarks.py --n-docs 2000 --doc-length 800 --output results.json
+
+Each stage runs in a forked child of a process that already holds the stage's inputs, so the 
+reported peak RSS covers that stage alone: peak_rss_kb is the child's high water mark (which 
+starts at the parent's resident size) and peak_rss_delta_kb what the stage added on top of it.
+'''
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import traceback
+from collections import OrderedDict
+from timeit import default_timer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from csg import CommonSequenceGenerator
+from normalizers import FusedBasicNormalizer
+from shingle_table import ShingleTable, CompactShingleTable
+from shingler import Shingler, SHINGLE_KEYS, SHINGLE_KEY_STRING
+from synthetic_corpus import SyntheticCorpus
+
+TABLE_TYPES = OrderedDict([('dict', ShingleTable), ('compact', CompactShingleTable)])
+
+
+def measure(stage_fn):
+    '''
+    Runs stage_fn() in a forked child and returns the dict it returns, with the stage's wall 
+    clock seconds and peak RSS added (or the traceback, under 'error', if it raised).
+    '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            gc.collect()
+            rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = default_timer()
+            result = stage_fn()
+            seconds = default_timer() - start
+            rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result.update(seconds = seconds, peak_rss_kb = rss_after, peak_rss_delta_kb = rss_after - rss_before)
+            payload = json.dumps(result)
+        except BaseException:
+            payload = json.dumps(dict(error = traceback.format_exc()))
+        with os.fdopen(write_fd, 'w') as pipe:
+            pipe.write(payload)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        payload = pipe.read()
+    os.waitpid(pid, 0)
+    return json.loads(payload)
+
+def run_benchmarks(corpus, shingle_size = 8, shingle_key = SHINGLE_KEY_STRING, table_type = 'dict',
+                   n_query_docs = 100, min_length = 1):
+    '''
+    Returns an OrderedDict stage name -> measurements for the stages:
+
+    shingle:            Shingler.shingle_docs over the corpus.
+    build_table:        Table construction from the materialized ShingleRecords.
+    invert:             table.invert().
+    generate_per_doc:   generate_common_sequences for the first n_query_docs documents.
+    generate_all:       generate_all_common_sequences over the corpus.
+    '''
+    shingler = Shingler(shingle_size, FusedBasicNormalizer().normalize, shingle_key = shingle_key)
+    table_cls = TABLE_TYPES[table_type]
+    stages = OrderedDict()
+
+    def shingle():
+        n_shingles = sum(1 for _ in shingler.shingle_docs(corpus))
+        return dict(n_docs = len(corpus), n_shingles = n_shingles)
+    stages['shingle'] = measure(shingle)
+
+    shingle_records = list(shingler.shingle_docs(corpus))
+    stages['build_table'] = measure(lambda: dict(n_shared_shingles = len(table_cls(shingle_records))))
+
+    table = table_cls(shingle_records)
+    shingle_records = None      # released before the later stages
+    stages['invert'] = measure(lambda: dict(n_docs_with_shared_shingles = len(table.invert())))
+
+    common_sequence_generator = CommonSequenceGenerator(table, min_length = min_length)
+    stages['generate_per_doc'] = measure(lambda: _generate_per_doc(common_sequence_generator, range(min(n_query_docs, len(corpus)))))
+    stages['generate_all'] = measure(lambda: dict(n_sequences = sum(1 for _ in common_sequence_generator.generate_all_common_sequences())))
+
+    return stages
+
+def _generate_per_doc(common_sequence_generator, doc_ids):
+
+    latencies = []
+    n_groups = 0
+    for doc_id in doc_ids:
+        start = default_timer()
+        if common_sequence_generator.has_shared_shingles(doc_id):
+            n_groups += len(common_sequence_generator.generate_common_sequences(doc_id))
+        latencies.append(default_timer() - start)
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+    return dict(n_docs = len(doc_ids), n_groups = n_groups, 
+                p50_seconds = percentile(0.5), p99_seconds = percentile(0.99), max_seconds = percentile(1.0))
+
+def _environment():
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                         stderr = open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(python = platform.python_version(), platform = platform.platform(), commit = commit)
+
+def _parse_args():
+
+    parser = argparse.ArgumentParser(description = 'Benchmark the common sequence pipeline on a synthetic corpus.')
+    parser.add_argument('--n-docs', type = int, default = 1000)
+    parser.add_argument('--doc-length', type = int, default = 500, help = 'tokens per document')
+    parser.add_argument('--vocabulary-size', type = int, default = 20000)
+    parser.add_argument('--n-quotes', type = int, default = 200)
+    parser.add_argument('--quote-rate', type = float, default = 0.1, help = 'fraction of tokens taken from quotes')
+    parser.add_argument('--boilerplate-rate', type = float, default = 0.2, help = 'fraction of documents with boilerplate')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--shingle-size', type = int, default = 8)
+    parser.add_argument('--shingle-key', choices = SHINGLE_KEYS, default = SHINGLE_KEY_STRING)
+    parser.add_argument('--table-type', choices = TABLE_TYPES.keys(), default = 'dict')
+    parser.add_argument('--n-query-docs', type = int, default = 100, help = 'documents timed by generate_per_doc')
+    parser.add_argument('--min-length', type = int, default = 1)
+    parser.add_argument('--output', help = 'JSON output path (default: stdout)')
+    return parser.parse_args()
+
+def main():
+
+    args = _parse_args()
+    corpus = SyntheticCorpus(n_docs = args.n_docs, doc_length = args.doc_length, vocabulary_size = args.vocabulary_size,
+                             n_quotes = args.n_quotes, quote_rate = args.quote_rate,
+                             boilerplate_rate = args.boilerplate_rate, seed = args.seed)
+    stages = run_benchmarks(corpus, shingle_size = args.shingle_size, shingle_key = args.shingle_key,
+                            table_type = args.table_type, n_query_docs = args.n_query_docs, min_length = args.min_length)
+
+    config = dict( (name, value) for name, value in vars(args).iteritems() if name != 'output' )
+    report = OrderedDict([('config', config), ('environment', _environment()), ('stages', stages)])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
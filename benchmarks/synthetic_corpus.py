@@ -0,0 +1,85 @@
+import random
+from bisect import bisect
+
+from dto import DocRecord
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+class SyntheticCorpus(object):
+
+    def __init__(self, n_docs = 1000, doc_length = 500, vocabulary_size = 20000, n_quotes = 200,
+                 quote_length = (8, 40), quote_rate = 0.1, n_boilerplates = 5, boilerplate_length = 30,
+                 boilerplate_rate = 0.2, seed = 0):
+        '''
+        Deterministic, lazily generated corpus of DocRecords (doc ids 0 .. n_docs - 1) with 
+        controllable reuse, for benchmarking. Documents are built from chunks of quote_length 
+        tokens; each chunk is one of n_quotes shared quotes with probability quote_rate and fresh 
+        text otherwise. Words are drawn from a Zipf distribution over the vocabulary, so common 
+        words (and hence short common shingles) recur as in natural text.
+
+        n_docs:             Number of documents.
+        doc_length:         Approximate number of tokens per document.
+        vocabulary_size:    Number of distinct words.
+        n_quotes:           Number of quotes documents borrow from.
+        quote_length:       (min, max) tokens per quote and per chunk of fresh text.
+        quote_rate:         Approximate fraction of a document's tokens taken from quotes.
+        n_boilerplates:     Number of boilerplate passages (headers / footers).
+        boilerplate_length: Tokens per boilerplate passage.
+        boilerplate_rate:   Probability that a document starts and ends with a boilerplate passage.
+        seed:               Every document is generated from (seed, doc_id), so iterating twice, 
+                            or asking for one doc_record, yields the same documents.
+        '''
+        self.n_docs = n_docs
+        self.doc_length = doc_length
+        self.quote_length = quote_length
+        self.quote_rate = quote_rate
+        self.boilerplate_rate = boilerplate_rate
+        self.seed = seed
+
+        rnd = random.Random(seed)
+        self._words = self._vocabulary(rnd, vocabulary_size)
+        self._word_weights = []
+        for rank in xrange(1, vocabulary_size + 1):
+            self._word_weights.append(1.0 / rank + (self._word_weights[-1] if self._word_weights else 0.0))
+
+        self._quotes = [self._fresh_text(rnd, rnd.randint(*quote_length)) for _ in xrange(n_quotes)]
+        self._boilerplates = [self._fresh_text(rnd, boilerplate_length) for _ in xrange(n_boilerplates)]
+
+    def __len__(self):
+        return self.n_docs
+
+    def __iter__(self):
+        for doc_id in xrange(self.n_docs):
+            yield self.doc_record(doc_id)
+
+    def doc_record(self, doc_id):
+
+        rnd = random.Random(hash((self.seed, doc_id)))
+        boilerplate = self._boilerplates and rnd.random() < self.boilerplate_rate
+        tokens = list(rnd.choice(self._boilerplates)) if boilerplate else []
+        while len(tokens) < self.doc_length:
+            if self._quotes and rnd.random() < self.quote_rate:
+                tokens.extend(rnd.choice(self._quotes))
+            else:
+                tokens.extend(self._fresh_text(rnd, rnd.randint(*self.quote_length)))
+        if boilerplate:
+            tokens.extend(rnd.choice(self._boilerplates))
+
+        return DocRecord(doc_id = doc_id, doc = u' '.join(tokens))
+
+    def _fresh_text(self, rnd, n_tokens):
+
+        total_weight = self._word_weights[-1]
+        return [self._words[bisect(self._word_weights, rnd.random() * total_weight)] for _ in xrange(n_tokens)]
+
+    def _vocabulary(self, rnd, vocabulary_size):
+
+        words = set()
+        while len(words) < vocabulary_size:
+            words.add(u''.join(rnd.choice(LETTERS) for _ in xrange(rnd.randint(3, 10))))
+
+        words = sorted(words)
+        rnd.shuffle(words)
+        return words
+
@@ -1,6 +1,17 @@
+from bisect import bisect_left
+import heapq
+from itertools import chain, count
+from operator import itemgetter
+
+from stats import timed
 
 
 class Sequence(object):
+
+    # Millions of sequences are created per corpus run: slots drop the per-instance __dict__.
+    # _target_length is None unless the target span differs in length (gapped matching across 
+    # an insertion or deletion).
+    __slots__ = ('_src_doc_id', '_src_position', '_target_doc_id', '_target_position', '_length', '_target_length')
     
     def __init__(self, src_doc_id, src_position, target_doc_id, target_position):
         self._src_doc_id = src_doc_id
@@ -8,6 +19,7 @@ class Sequence(object):
         self._target_doc_id = target_doc_id
         self._target_position = target_position
         self._length = 1
+        self._target_length = None
 
     @property
     def src_doc_id(self):
@@ -29,13 +41,17 @@ class Sequence(object):
     def length(self):
         return self._length
 
+    @property
+    def target_length(self):
+        return self._length if self._target_length is None else self._target_length
+
     @property 
     def src_end_position(self):
-        return self._src_position + self.length
+        return self._src_position + self._length
 
     @property 
     def target_end_position(self):
-        return self._target_position + self.length
+        return self._target_position + self.target_length
 
     @src_doc_id.setter
     def src_doc_id(self, value):
@@ -57,9 +73,21 @@ class Sequence(object):
     def length(self, value):
         raise AttributeError('\'length\' is read only. Use \'increment\' to increment.')
 
+    @target_length.setter
+    def target_length(self, value):
+        raise AttributeError('\'target_length\' is read only.')
+
     def increment_length(self):
         self._length = self._length + 1
 
+    def __getstate__(self):
+        return (self._src_doc_id, self._src_position, self._target_doc_id, self._target_position, self._length, self._target_length)
+
+    def __setstate__(self, state):
+        # Sequences pickled before target_length have five fields.
+        self._src_doc_id, self._src_position, self._target_doc_id, self._target_position, self._length = state[:5]
+        self._target_length = state[5] if len(state) > 5 else None
+
     def __hash__(self):
         return hash((self.src_position, self.target_doc_id, self.target_position))
 
@@ -69,7 +97,8 @@ class Sequence(object):
                 self._src_position == other._src_position and
                 self._target_doc_id == other._target_doc_id and 
                 self._target_position == other._target_position and
-                self._length == self._length
+                self._length == other._length and
+                self._target_length == other._target_length
                 )
 
     def __repr__(self):
@@ -85,103 +114,553 @@ class Sequence(object):
                              )
 
 
-# TODO: functionality to recover source text from Sequence object
+def sequence_order(seq):
+    '''Sort key putting sequences in source order, longest first, then by target.'''
+    return (seq.src_position, -seq.length, seq.target_doc_id, seq.target_position)
+
+
+# Policies for matches between a document and itself.
+SELF_MATCH_EXCLUDE = 'exclude'                  # Only other documents are targets.
+SELF_MATCH_NON_OVERLAPPING = 'non_overlapping'  # Repeats within the document whose tokens never overlap their source's.
+SELF_MATCH_ALLOW = 'allow'                      # Every same document match, including each shingle with itself.
+SELF_MATCH_POLICIES = (SELF_MATCH_EXCLUDE, SELF_MATCH_NON_OVERLAPPING, SELF_MATCH_ALLOW)
+
+END_OF_DOCUMENT = float('inf')     # frontier past every source position
+
 # TODO: make adjustments for implementation on distributed system / spark
 # TODO: uniform object for shingle -- either tuple or named tuple (ShingleRecord vs whats in inverted_shingle_table)
 class CommonSequenceGenerator(object):
 
 
-    def __init__(self, shingle_table):
+    def __init__(self, shingle_table, self_match_policy = SELF_MATCH_EXCLUDE, verify_shingles = False,
+                 min_length = 1, max_targets_per_group = None, top_k = None, max_gap = 0, stats = None):
         '''
         shingle_table: shingle:     shingle -> set( [(doc_id_1, position_1), ..., (doc_id_n, position_n)] )
         ( shingle_table.invert():   doc_id -> [(shingle_1, position_1), ..., (shingle_m, position_m)], where i > j => position_i > position_j )
+        self_match_policy:          One of SELF_MATCH_POLICIES, deciding which matches between a document and 
+                                    itself are reported. With SELF_MATCH_NON_OVERLAPPING a run is split as soon as 
+                                    the tokens of its source and target would overlap (a run of n shingles covers 
+                                    n + shingle_size - 1 tokens), which requires shingle_table.shingler for the 
+                                    shingle size.
+        verify_shingles:            Re-check every run against the documents' normalized tokens and split it 
+                                    wherever shingles only matched by hash collision. Requires a table built 
+                                    with a Shingler(keep_tokens = True) as shingle_table.shingler.
+        min_length:                 Minimum length (in shingles) of a reported sequence. Shorter runs are dropped 
+                                    as they close, before any Sequence is built or grouped.
+        max_targets_per_group:      Keep only the sequences of the max_targets_per_group target documents with the 
+                                    longest sequence in each group (default: all).
+        top_k:                      Return only the top_k longest groups per document, still in source order 
+                                    (default: all). generate_all_common_sequences only applies min_length.
+        max_gap:                    Approximate matching: a run survives up to max_gap consecutive source positions 
+                                    without a hit on its diagonal, so a substituted token (which breaks the 
+                                    shingle_size shingles containing it) no longer splits a quote when max_gap 
+                                    >= shingle_size. A run also continues on a diagonal shifted by up to max_gap 
+                                    when both its source and target gaps are at most max_gap, bridging an 
+                                    insertion or deletion of up to max_gap - shingle_size + 1 tokens; such 
+                                    sequences have a target_length different from their length. Gaps count 
+                                    towards both lengths.
+        stats:                      Optional stats.Stats recording the load_inversion, sweep and group stages 
+                                    and source_positions, postings_probed, runs_opened, runs_closed, sequences_emitted, groups 
+                                    and the max_active_runs maximum.
         '''
-        self._shingle_table = shingle_table
-        self._inverted_shingle_table = shingle_table.invert()
+        if self_match_policy not in SELF_MATCH_POLICIES:
+            raise ValueError('Unknown self_match_policy {0!r}, expected one of {1}.'.format(self_match_policy, SELF_MATCH_POLICIES))
+
+        shingler = getattr(shingle_table, 'shingler', None)
+        if verify_shingles and (shingler is None or shingler.doc_tokens is None):
+            raise ValueError('verify_shingles requires a shingle table built with a Shingler(keep_tokens = True).')
+
+        if self_match_policy == SELF_MATCH_NON_OVERLAPPING and shingler is None:
+            raise ValueError('SELF_MATCH_NON_OVERLAPPING requires a shingle table built with a shingler, for its shingle size.')
 
+        for name, value in (('min_length', min_length), ('max_targets_per_group', max_targets_per_group), ('top_k', top_k)):
+            if value is not None and value < 1:
+                raise ValueError('{0} must be at least 1, got {1!r}.'.format(name, value))
 
-    def generate_common_sequences(self, doc_id):
+        if max_gap < 0:
+            raise ValueError('max_gap must be at least 0, got {0!r}.'.format(max_gap))
+
+        if max_gap and verify_shingles:
+            raise ValueError('verify_shingles would split gapped runs at their gaps; it requires max_gap = 0.')
+
+        self._stats = stats
+        self._shingle_table = shingle_table
+        with timed(stats, 'load_inversion'):
+            self._inverted_shingle_table = shingle_table.invert()
+        self._self_match_policy = self_match_policy
+        self._shingle_size = shingler.shingle_size if shingler is not None else None
+        self._verify_shingles = verify_shingles
+        self._min_length = min_length
+        self._max_targets_per_group = max_targets_per_group
+        self._top_k = top_k
+        self._max_gap = max_gap
+        self._sweep = self._sweep_gapped_diagonals if max_gap else self._sweep_diagonals
+
+    def has_shared_shingles(self, doc_id):
+        '''
+        True if doc_id shares at least one shingle with the corpus. generate_common_sequences 
+        raises KeyError for any other doc_id (unknown documents included).
+        '''
+        return doc_id in self._inverted_shingle_table
+
+    def generate_common_sequences(self, doc_id, target_doc_ids = None):
         '''
         Given a doc_id, produce a list sequences shared between the 
         specified document and other documents in the corpus implicit 
         in this instance's shingle table.
-        '''
 
-        common_seqs = []  
-        active_seqs = set()
+        target_doc_ids: Optional collection of the other documents to match against (e.g. the 
+                        LSHIndex candidates of doc_id); postings of any other document are skipped 
+                        before a run is opened. Self matches still follow the self match policy.
+        '''
 
         src_shingles = self._inverted_shingle_table[doc_id]
-        prev_src_shingle = None
-        for src_shingle in src_shingles: # src_shingle = (text, i)
-            src_shingle_text, src_position = src_shingle
-            if not self._consecutive(prev_src_shingle, src_shingle):
-                self._close_active_seqs(active_seqs, common_seqs)
+        with timed(self._stats, 'sweep'):
+            common_seqs = self._sweep(doc_id, self._table_postings(src_shingles), self._target_filter(target_doc_ids))
+            common_seqs = list(self._verified(common_seqs, self._doc_tokens(doc_id)))
 
-            target_shingle_locs = self._shingle_table[src_shingle_text].copy() # .copy() if generate_common_sequences used multiple times
-            self._process_active_seqs(active_seqs, common_seqs, target_shingle_locs)
+        return self._group_sequences(common_seqs)
 
-            self._process_target_shingles(active_seqs, target_shingle_locs, doc_id, src_position, src_shingles)
+    def iter_common_sequences(self, doc_id, target_doc_ids = None):
+        '''
+        Lazy generate_common_sequences: yields the SequenceGroups of doc_id in source order, each 
+        as soon as the sweep has moved past the point where a later sequence could still join it. 
+        Only the runs still open and the closed runs not yet grouped are held in memory.
 
-            prev_src_shingle = src_shingle
+        The groups are those of generate_common_sequences, as is target_doc_ids. top_k needs every group of the 
+        document before choosing, so it is not supported here.
+        '''
+        if self._top_k is not None:
+            raise ValueError('top_k is not supported by iter_common_sequences, use generate_common_sequences.')
+
+        src_tokens = self._doc_tokens(doc_id)
+        src_postings = self._table_postings(self._inverted_shingle_table[doc_id])
+        closed_seqs = []        # heap of (sequence_order(seq), n, seq) closed but not yet grouped
+        closed_order = count()
+        active_group = None
+        sweep = self._sweep(doc_id, src_postings, self._target_filter(target_doc_ids), track_frontier = True)
+        for item in chain(sweep, [END_OF_DOCUMENT]):
+            if isinstance(item, Sequence):
+                for seq in self._verified([item], src_tokens):
+                    heapq.heappush(closed_seqs, (sequence_order(seq), next(closed_order), seq))
+                continue
+
+            # No sequence closed from now on can start before the frontier.
+            frontier = item
+            while closed_seqs and closed_seqs[0][0][0] < frontier:
+                _, _, seq = heapq.heappop(closed_seqs)
+                if active_group is not None and active_group.includes(seq):
+                    active_group.add_sequence(seq)
+                    continue
+                if active_group is not None:
+                    yield self._pruned_group(active_group)
+                active_group = SequenceGroup(seq)
+
+            if active_group is not None and frontier >= active_group.span[1]:
+                yield self._pruned_group(active_group)
+                active_group = None
+
+    def _pruned_group(self, group):
+
+        if self._max_targets_per_group is None:
+            return group
+
+        return self._prune_targets(group)
+
+    def find_common_sequences(self, doc_record, target_doc_ids = None):
+        '''
+        Given a DocRecord that need not be in the corpus, produce the list of sequence groups it 
+        shares with the documents in this instance's shingle table, without modifying the table. 
+        The document is shingled with the table's own shingler (shingle_table.shingler), without 
+        adding its new tokens to the shingler's token ids, and every shingle is probed read only. On tables built with retain_uniques = True, shingles that 
+        were purged as unique are matched as well. target_doc_ids is as for generate_common_sequences.
+        '''
+        shingler = getattr(self._shingle_table, 'shingler', None)
+        if shingler is None:
+            raise ValueError('find_common_sequences requires a shingle table built with a shingler.')
 
-        self._close_active_seqs(active_seqs, common_seqs)
+        src_tokens = shingler.normalized_tokens(doc_record.doc)
+        with timed(self._stats, 'sweep'):
+            src_postings = self._probe_postings(shingler.shingle_tokens(doc_record.doc_id, src_tokens, assign_token_ids = False))
+            common_seqs = self._sweep(doc_record.doc_id, src_postings, self._target_filter(target_doc_ids))
+            common_seqs = list(self._verified(common_seqs, src_tokens))
 
-        return SequenceGroup.group_sequences(common_seqs)
+        return self._group_sequences(common_seqs)
 
-    def _consecutive(self, prev_src_shingle, cur_src_shingle):
+    def _target_filter(self, target_doc_ids):
 
-        if prev_src_shingle is not None:
-            return prev_src_shingle[1] == (cur_src_shingle[1] - 1)
+        if target_doc_ids is None:
+            return None
 
-        return True
+        target_doc_ids = target_doc_ids if isinstance(target_doc_ids, (set, frozenset, dict)) else set(target_doc_ids)
+        return target_doc_ids.__contains__
 
+    def _group_sequences(self, common_seqs):
 
-    def _process_active_seqs(self, active_seqs, common_seqs, target_shingle_locs):
-        
-        seqs_to_discontinue = set()
-        for seq in active_seqs:
-            self._process_active_seq(seq, active_seqs, common_seqs, target_shingle_locs, seqs_to_discontinue)
+        with timed(self._stats, 'group'):
+            groups = [self._pruned_group(group) for group in SequenceGroup.group_sequences(common_seqs)]
+            if self._top_k is not None and len(groups) > self._top_k:
+                top_groups = heapq.nlargest(self._top_k, enumerate(groups), key = lambda (i, group): (group.length, -i))
+                groups = [group for _, group in sorted(top_groups)]
 
-        active_seqs.difference_update(seqs_to_discontinue)
+        if self._stats is not None:
+            self._stats.increment('groups', len(groups))
 
-    def _process_active_seq(self, seq, active_seqs, common_seqs, target_shingle_locs, seqs_to_discontinue):
+        return groups
 
-        next_target_shingle_loc = self._get_next_target_shingle_loc(seq)
+    def _prune_targets(self, group):
 
-        # Common sequence between src and trg continues.
-        if next_target_shingle_loc in target_shingle_locs:
-            seq.increment_length()
-            target_shingle_locs.remove(next_target_shingle_loc) # So that you don't start a new sequence 
-                                                             # for this shingle in _process_target_shingles.
+        longest = {}
+        for seq in group.sequences:
+            longest[seq.target_doc_id] = max(longest.get(seq.target_doc_id, 0), seq.length)
+        if len(longest) <= self._max_targets_per_group:
+            return group
 
-        # Common sequence between src and trg ends.
-        else:
-            common_seqs.append(seq)
-            seqs_to_discontinue.add(seq)
+        ranked_targets = sorted(longest.iteritems(), key = itemgetter(1), reverse = True)
+        kept_targets = set(target_doc_id for target_doc_id, _ in ranked_targets[:self._max_targets_per_group])
+        return SequenceGroup.from_sequences([seq for seq in group.sequences if seq.target_doc_id in kept_targets])
 
-    def _get_next_target_shingle_loc(self, sequence):
+    def _table_postings(self, src_shingles):
 
-        next_target_shingle_pos = sequence.target_position + sequence.length
-        return (sequence.target_doc_id, next_target_shingle_pos)
+        for src_shingle_text, src_position in src_shingles:
+            yield src_position, self._shingle_table[src_shingle_text]
 
-    def _process_target_shingles(self, active_seqs, target_shingle_locs, doc_id, src_position, src_shingles):
-        # All target shingles remaining in target_shingle_locs represent 
-        # the first shingle in the start of a new common sequence.
-        
-        for (target_doc_id, target_position) in target_shingle_locs:
-            if (target_doc_id, target_position) not in src_shingles:
-                new_seq = Sequence( src_doc_id = doc_id, 
-                                    src_position = src_position, 
-                                    target_doc_id = target_doc_id, 
-                                    target_position = target_position)
-                active_seqs.add(new_seq)
+    def _probe_postings(self, shingle_records):
+        # Shingles absent from the table are skipped; the sweep treats the hole as a break.
 
-    def _close_active_seqs(self, active_seqs, common_seqs):
-        common_seqs.extend(active_seqs)
-        active_seqs.clear()
+        for shingle_record in shingle_records:
+            postings = self._shingle_table.postings(shingle_record.shingle)
+            if postings:
+                yield shingle_record.i, postings
+
+    def generate_all_common_sequences(self):
+        '''
+        Streams the common sequences between every pair of distinct documents in the corpus, 
+        reporting each pair's maximal runs exactly once. Documents are swept in doc_id order 
+        against only the postings that sort after the source posting by (doc_id, position), so 
+        every pair of postings of a shared shingle is visited once, from its earlier side, and 
+        the mirrored B -> A runs are never probed. Each bucket is sorted once, on its first visit. 
+        The whole corpus costs O(total shared posting pairs + total shared postings log n), 
+        about half the probes of one generate_common_sequences call per document.
+
+        Unless the self match policy excludes them, repeats within a document are reported once as 
+        well, from the earlier to the later occurrence (never a shingle with itself).
+
+        Yields Sequence objects, grouped by source document in doc_id order.
+        '''
+        doc_ids = sorted(self._inverted_shingle_table)
+        doc_ranks = dict( (doc_id, rank) for rank, doc_id in enumerate(doc_ids) )
+        sorted_buckets = {}
+        for doc_id in doc_ids:
+            src_postings = self._later_postings(self._inverted_shingle_table[doc_id], doc_ranks, sorted_buckets)
+            common_seqs = self._sweep(doc_id, src_postings, forward_self_matches_only = True)
+            for seq in self._verified(common_seqs, self._doc_tokens(doc_id)):
+                yield seq
+
+    def _later_postings(self, src_shingles, doc_ranks, sorted_buckets):
+        # Documents are swept in rank order and the shingles of each by position, so the postings 
+        # of a bucket are reached as sources in (rank, position) order: the k-th visit of a bucket 
+        # is at its k-th posting in that order, and the postings after it are the ones to probe. 
+        # sorted_buckets holds [sorted bucket, visits] from a bucket's first visit to its last.
+
+        for shingle, src_position in src_shingles:
+            sorted_bucket = sorted_buckets.get(shingle)
+            if sorted_bucket is None:
+                bucket = sorted(self._shingle_table[shingle], key = lambda (doc_id, i): (doc_ranks[doc_id], i))
+                sorted_bucket = sorted_buckets[shingle] = [bucket, 0]
+
+            bucket, k = sorted_bucket
+            if k + 1 < len(bucket):
+                sorted_bucket[1] = k + 1
+            else:
+                del sorted_buckets[shingle]
+            yield src_position, bucket[k + 1:]
+
+    def _sweep_diagonals(self, doc_id, src_postings, accept_target = None, forward_self_matches_only = False,
+                         track_frontier = False):
+        # A run between the source and a target is identified by its diagonal: every shingle of 
+        # the run sits at the same (target_doc_id, target_position - src_position). Each posting 
+        # of the current source shingle extends the run on its diagonal if that run was extended 
+        # at the previous source position, and opens a new run otherwise; runs not extended at the 
+        # current position are closed. This is O(1) per posting, with no copy of the bucket.
+        # Active runs are only their start position; a Sequence is built when a run closes, and 
+        # only if it is at least min_length long. With track_frontier, the earliest source position 
+        # a run closed later may start at is yielded (as an int) after every source position.
+
+        exclude_self_matches = self._self_match_policy == SELF_MATCH_EXCLUDE
+        # Runs are verified after they close, and a run lengthened by hash collisions would be 
+        # split in the wrong places: with verify_shingles, _verified splits the verified runs.
+        split_self_overlaps = self._self_match_policy == SELF_MATCH_NON_OVERLAPPING and not self._verify_shingles
+        stats = self._stats
+        active_runs = {}
+        prev_src_position = None
+        for src_position, target_shingle_locs in src_postings:
+            if prev_src_position is not None and src_position != prev_src_position + 1:
+                for seq in self._closed_runs(doc_id, active_runs, prev_src_position):
+                    yield seq
+                active_runs = {}
+
+            extended_runs = {}
+            for target_doc_id, target_position in target_shingle_locs:
+                offset = target_position - src_position
+                self_match = target_doc_id == doc_id
+                if self_match:
+                    if exclude_self_matches or not self._accept_self_match(offset, forward_self_matches_only):
+                        continue
+
+                elif accept_target is not None and not accept_target(target_doc_id):
+                    continue
+
+                diagonal = (target_doc_id, offset)
+                run_start = active_runs.pop(diagonal, src_position)
+                if self_match and split_self_overlaps and src_position - run_start + self._shingle_size > abs(offset):
+                    # One more shingle would make the run overlap its own source span.
+                    for seq in self._closed_runs(doc_id, {diagonal: run_start}, prev_src_position):
+                        yield seq
+                    run_start = src_position
+                extended_runs[diagonal] = run_start
+
+            for seq in self._closed_runs(doc_id, active_runs, prev_src_position):
+                yield seq
+
+            active_runs = extended_runs
+            prev_src_position = src_position
+            if stats is not None:
+                # Runs extended here started earlier; the ones starting here were just opened.
+                stats.increment('runs_opened', sum(1 for run_start in extended_runs.itervalues() if run_start == src_position))
+                stats.increment('source_positions')
+                stats.increment('postings_probed', len(target_shingle_locs))
+                stats.maximum('max_active_runs', len(active_runs))
+            if track_frontier:
+                yield min(active_runs.itervalues()) if active_runs else src_position + 1
+
+        for seq in self._closed_runs(doc_id, active_runs, prev_src_position):
+            yield seq
+
+    def _sweep_gapped_diagonals(self, doc_id, src_postings, accept_target = None, forward_self_matches_only = False,
+                                track_frontier = False):
+        # The max_gap > 0 sweep. As _sweep_diagonals, but runs survive small edits:
+        # - substitutions: a run stays open while its last hit is at most max_gap source positions 
+        #   behind;
+        # - insertions and deletions shift the diagonal: a hit that would open a new run first 
+        #   looks for a run that was not extended at this position on a neighbouring diagonal 
+        #   (offset +- max_gap, same target) whose last hit is at most max_gap positions behind in 
+        #   both documents, and moves that run onto its own diagonal.
+        # Open runs are [src_start, last_src_position, target_start, last_target_position], keyed 
+        # by their current diagonal. They are also listed, with that diagonal, under the position 
+        # of their last hit; once a position falls more than max_gap + 1 behind, the runs still 
+        # last extended there are closed (entries of runs extended or moved since are stale and 
+        # skipped).
+
+        exclude_self_matches = self._self_match_policy == SELF_MATCH_EXCLUDE
+        split_self_overlaps = self._self_match_policy == SELF_MATCH_NON_OVERLAPPING
+        stats = self._stats
+        open_runs = {}
+        runs_by_last_hit = {}
+        for src_position, target_shingle_locs in src_postings:
+            expired = sorted(last for last in runs_by_last_hit if last < src_position - self._max_gap - 1)
+            for last in expired:
+                for seq in self._closed_gapped_runs(doc_id, open_runs, runs_by_last_hit.pop(last), last):
+                    yield seq
+
+            extended = runs_by_last_hit.setdefault(src_position, [])
+            unextended_hits = []
+            for target_doc_id, target_position in target_shingle_locs:
+                offset = target_position - src_position
+                self_match = target_doc_id == doc_id
+                if self_match:
+                    if exclude_self_matches or not self._accept_self_match(offset, forward_self_matches_only):
+                        continue
+
+                elif accept_target is not None and not accept_target(target_doc_id):
+                    continue
+
+                diagonal = (target_doc_id, offset)
+                run = open_runs.get(diagonal)
+                if run is not None and self_match and split_self_overlaps and self._self_overlap(run, src_position, target_position):
+                    # One more shingle would make the run overlap its own source span.
+                    for seq in self._closed_gapped_runs(doc_id, open_runs, [(diagonal, run)], run[1]):
+                        yield seq
+                    run = None
+
+                if run is None:
+                    unextended_hits.append( (diagonal, target_position, self_match and split_self_overlaps) )
+                else:
+                    run[1], run[3] = src_position, target_position
+                    extended.append( (diagonal, run) )
+
+            # Only now are the runs that broke at this position known.
+            n_opened = 0
+            for diagonal, target_position, split_self_overlap in unextended_hits:
+                run = self._shifted_run(open_runs, diagonal, src_position, target_position, split_self_overlap)
+                if run is None:
+                    run = [src_position, src_position, target_position, target_position]
+                    n_opened += 1
+                else:
+                    run[1], run[3] = src_position, target_position
+                open_runs[diagonal] = run
+                extended.append( (diagonal, run) )
+
+            if stats is not None:
+                stats.increment('runs_opened', n_opened)
+                stats.increment('source_positions')
+                stats.increment('postings_probed', len(target_shingle_locs))
+                stats.maximum('max_active_runs', len(open_runs))
+            if track_frontier:
+                yield min(run[0] for run in open_runs.itervalues()) if open_runs else src_position + 1
+
+        for last in sorted(runs_by_last_hit):
+            for seq in self._closed_gapped_runs(doc_id, open_runs, runs_by_last_hit[last], last):
+                yield seq
+
+    def _shifted_run(self, open_runs, diagonal, src_position, target_position, split_self_overlap):
+        # The closest open run on a neighbouring diagonal that the hit continues across an 
+        # insertion or deletion, removed from open_runs, or None. Runs expire once their source 
+        # gap exceeds max_gap, so only the target gap is checked here.
+
+        target_doc_id, offset = diagonal
+        for shift in xrange(1, self._max_gap + 1):
+            for shifted_diagonal in ((target_doc_id, offset - shift), (target_doc_id, offset + shift)):
+                run = open_runs.get(shifted_diagonal)
+                if (run is not None and run[1] < src_position and run[3] < target_position <= run[3] + self._max_gap + 1 and 
+                        not (split_self_overlap and self._self_overlap(run, src_position, target_position))):
+                    del open_runs[shifted_diagonal]
+                    return run
+
+        return None
+
+    def _self_overlap(self, run, src_position, target_position):
+        # Whether the tokens of run, extended to these positions, overlap in source and target 
+        # (a run of n shingles covers n + shingle_size - 1 tokens).
+        return max(run[0], run[2]) <= min(src_position, target_position) + self._shingle_size - 1
+
+    def _closed_gapped_runs(self, doc_id, open_runs, diagonal_runs, last_src_position):
+
+        closed_runs = []
+        for diagonal, run in diagonal_runs:
+            if open_runs.get(diagonal) is run and run[1] == last_src_position:
+                del open_runs[diagonal]
+                closed_runs.append( (diagonal[0], run) )
+
+        if self._stats is not None:
+            self._stats.increment('runs_closed', len(closed_runs))
+        for target_doc_id, (src_start, last_src_position, target_start, last_target_position) in closed_runs:
+            length = last_src_position - src_start + 1
+            if length >= self._min_length:
+                if self._stats is not None:
+                    self._stats.increment('sequences_emitted')
+                seq = Sequence( src_doc_id = doc_id, 
+                                src_position = src_start, 
+                                target_doc_id = target_doc_id, 
+                                target_position = target_start)
+                seq._length = length
+                if last_target_position - target_start + 1 != length:
+                    seq._target_length = last_target_position - target_start + 1
+                yield seq
+
+    def _closed_runs(self, doc_id, runs, last_src_position):
+
+        if self._stats is not None:
+            self._stats.increment('runs_closed', len(runs))
+        for (target_doc_id, offset), run_start in runs.iteritems():
+            length = last_src_position - run_start + 1
+            if length >= self._min_length:
+                if self._stats is not None:
+                    self._stats.increment('sequences_emitted')
+                seq = Sequence( src_doc_id = doc_id, 
+                                src_position = run_start, 
+                                target_doc_id = target_doc_id, 
+                                target_position = run_start + offset)
+                seq._length = length
+                yield seq
+
+    def _doc_tokens(self, doc_id):
+
+        if not self._verify_shingles:
+            return None
+
+        return self._shingle_table.shingler.doc_tokens[doc_id]
+
+    def _verified(self, common_seqs, src_tokens):
+
+        if not self._verify_shingles:
+            return common_seqs
+
+        verified_seqs = (verified_seq for seq in common_seqs for verified_seq in self._verify_sequence(seq, src_tokens))
+        if self._self_match_policy != SELF_MATCH_NON_OVERLAPPING:
+            return verified_seqs
+
+        return (split_seq for seq in verified_seqs for split_seq in self._split_self_overlap(seq))
+
+    def _split_self_overlap(self, seq):
+        # As the split in _sweep_diagonals: a self match is cut into runs of the most shingles 
+        # that do not overlap their own source span, |offset| - shingle_size + 1.
+
+        offset = seq.target_position - seq.src_position
+        max_length = abs(offset) - self._shingle_size + 1
+        if seq.target_doc_id != seq.src_doc_id or seq.length <= max_length:
+            yield seq
+            return
+
+        for start in xrange(0, seq.length, max_length):
+            length = min(max_length, seq.length - start)
+            if length < self._min_length:
+                continue
+            split_seq = Sequence( src_doc_id = seq.src_doc_id, 
+                                  src_position = seq.src_position + start, 
+                                  target_doc_id = seq.target_doc_id, 
+                                  target_position = seq.target_position + start)
+            split_seq._length = length
+            yield split_seq
+
+    def _verify_sequence(self, seq, src_tokens):
+        # A run of length n covers n + shingle_size - 1 tokens on either side. If they all agree, 
+        # every shingle of the run truly matched; otherwise the run is split into the maximal 
+        # stretches of shingles whose tokens agree.
+
+        target_tokens = src_tokens if seq.target_doc_id == seq.src_doc_id else self._doc_tokens(seq.target_doc_id)
+        shingle_size = self._shingle_table.shingler.shingle_size
+        src_position, target_position = seq.src_position, seq.target_position
+        n_tokens = seq.length + shingle_size - 1
+        if src_tokens[src_position:src_position + n_tokens] == target_tokens[target_position:target_position + n_tokens]:
+            yield seq
+            return
+
+        run_start = None
+        for j in xrange(seq.length + 1):
+            matches = j < seq.length and (
+                          src_tokens[src_position + j:src_position + j + shingle_size] == 
+                          target_tokens[target_position + j:target_position + j + shingle_size]
+                      )
+            if matches and run_start is None:
+                run_start = j
+            elif not matches and run_start is not None:
+                if j - run_start < self._min_length:
+                    run_start = None
+                    continue
+                verified_seq = Sequence( src_doc_id = seq.src_doc_id, 
+                                         src_position = src_position + run_start, 
+                                         target_doc_id = seq.target_doc_id, 
+                                         target_position = target_position + run_start)
+                verified_seq._length = j - run_start
+                yield verified_seq
+                run_start = None
+
+    def _accept_self_match(self, offset, forward_only):
+
+        if forward_only and offset <= 0:
+            return False
+
+        if self._self_match_policy == SELF_MATCH_NON_OVERLAPPING:
+            # Closer repeats overlap their source within a single shingle.
+            return abs(offset) >= self._shingle_size
+
+        return offset != 0 or self._self_match_policy == SELF_MATCH_ALLOW
 
 class SequenceGroup(object):
 
+    __slots__ = ('_start_position', '_end_position', '_active_sequence', '_sequences')
+
     def __init__(self, seed_sequence):
 
         self._start_position = seed_sequence.src_position
@@ -193,6 +672,10 @@ class SequenceGroup(object):
     def active_sequence(self):
         return self._active_sequence
 
+    @property
+    def sequences(self):
+        return self._sequences
+
     @property
     def span(self):
         return (self._start_position, self._end_position)
@@ -204,7 +687,7 @@ class SequenceGroup(object):
     def add_sequence(self, sequence):
 
         if not self.includes(sequence):
-            raise ValueError('Attempting to add sequences that does not overlap with the active sequence.')
+            raise ValueError('Attempting to add sequences that does not overlap with the group span.')
 
         self._update_active_sequence(sequence)
         self._update_start_position(sequence)
@@ -225,33 +708,95 @@ class SequenceGroup(object):
         self._sequences.add(new_sequence)
 
     def includes(self, candidate_sequence):
-        return self._overlaps(self.active_sequence, candidate_sequence)
-
-    def _overlaps(self, left_seq, right_seq):
-        return left_seq.src_end_position > right_seq.src_position
+        return (candidate_sequence.src_position < self._end_position and 
+                candidate_sequence.src_end_position > self._start_position)
 
     def _subsumes(self, left_seq, right_seq):
         return ( (left_seq.src_position == right_seq.src_position) and
                 (left_seq.src_end_position > right_seq.src_end_position) )
 
+    def __getstate__(self):
+        return (self._start_position, self._end_position, self._active_sequence, self._sequences)
+
+    def __setstate__(self, state):
+        self._start_position, self._end_position, self._active_sequence, self._sequences = state
+
     def __repr__(self):
         return self._sequences.__repr__()
 
 
     @staticmethod
-    def group_sequences(ordered_sequences):
-        
-        if not ordered_sequences:
-            return []
+    def from_sequences(sequences):
+        '''
+        Builds one group spanning the given (non empty) sequences, whether or not they overlap, 
+        e.g. what is left of a group after some of its sequences were filtered out.
+        '''
+        sequences = sorted(sequences, key = sequence_order)
+        group = SequenceGroup(sequences[0])
+        for sequence in sequences[1:]:
+            group._update_start_position(sequence)
+            group._update_end_position(sequence)
+            group._add_sequence(sequence)
 
-        active_group = SequenceGroup(ordered_sequences.pop(0))
-        groups = [active_group]
-        for next_sequence in ordered_sequences:
-            if active_group.includes(next_sequence):
-                active_group.add_sequence(next_sequence)
+        return group
+
+    @staticmethod
+    def group_sequences(sequences):
+        '''
+        Partitions sequences, in any order, into groups whose source spans overlap: a sequence 
+        joins a group as soon as it overlaps the span of everything grouped so far. The 
+        sequences are sorted by source position (longest first) rather than popped or modified, 
+        so grouping is O(n log n) and the groups come out in source order whatever the input 
+        order.
+        '''
+        groups = []
+        active_group = None
+        for sequence in sorted(sequences, key = sequence_order):
+            if active_group is not None and active_group.includes(sequence):
+                active_group.add_sequence(sequence)
 
             else:
-                active_group = SequenceGroup(next_sequence)
+                active_group = SequenceGroup(sequence)
                 groups.append(active_group)
 
         return groups
+
+
+class SequenceGroupIndex(object):
+
+    def __init__(self, groups):
+        '''
+        Read only interval index over SequenceGroups, e.g. the groups of one document, answering 
+        which groups cover a source position or overlap a source span. Groups are sorted by span 
+        with the running maximum of their end positions, so a query is a bisection plus a scan 
+        of the groups starting before the queried span that could still reach into it: 
+        O(log n + k) for the disjoint groups of group_sequences.
+        '''
+        self._groups = sorted(groups, key = lambda group: group.span)
+        self._starts = [group.span[0] for group in self._groups]
+        self._max_ends = []
+        for group in self._groups:
+            self._max_ends.append(max(group.span[1], self._max_ends[-1] if self._max_ends else group.span[1]))
+
+    def __len__(self):
+        return len(self._groups)
+
+    def __iter__(self):
+        return iter(self._groups)
+
+    def covering(self, src_position):
+        '''Returns the groups whose span contains src_position, in source order.'''
+        return self.overlapping(src_position, src_position + 1)
+
+    def overlapping(self, start_position, end_position):
+        '''Returns the groups whose span overlaps [start_position, end_position), in source order.'''
+
+        i = bisect_left(self._starts, end_position)
+        groups = []
+        while i > 0 and self._max_ends[i - 1] > start_position:
+            i -= 1
+            if self._groups[i].span[1] > start_position:
+                groups.append(self._groups[i])
+
+        groups.reverse()
+        return groups
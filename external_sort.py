@@ -0,0 +1,210 @@
+import heapq
+import marshal
+import os
+import shutil
+import sys
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+from shingle_table import MappedShingleTable, POSTING_TYPECODE, OFFSET_TYPECODE, check_string_shingles, shingler_config
+from table_store import write_header, ArrayWriter, StringsWriter
+
+SPILL_BLOCK_SIZE = 4096         # records per marshal block in a spilled run
+RECORD_OVERHEAD = 160           # approximate bytes of a buffered record, beyond its shingle
+MAX_MERGE_FAN_IN = 256          # runs open at once while merging
+
+
+def build_table_on_disk(shingle_record_iter, path, memory_budget = 256 * 2 ** 20, tmp_dir = None, shingler = None):
+    '''
+    Builds a table from corpora larger than memory, writing it in the on-disk format of
+    CompactShingleTable.save and returning it opened as a MappedShingleTable, whose postings and
+    inverted lists are streamed from disk by CommonSequenceGenerator.
+
+    1. ShingleRecords are buffered up to memory_budget, sorted by (shingle, doc, position) and
+       spilled to temporary runs.
+    2. The runs are k-way merged. Shingles seen at least twice get consecutive ids and have their
+       postings appended to the table files; each of their postings is fed to a second external
+       sort keyed by (doc, position).
+    3. The second sort is merged into the per-document inverted lists.
+
+    Only the doc id list, one block per run and the sort buffers are held in memory.
+
+    shingle_record_iter:    Iterable of ShingleRecord objects.
+    path:                   Output directory.
+    memory_budget:          Approximate bytes of records buffered by each sort before spilling.
+    tmp_dir:                Directory for the spilled runs (default: the system temp directory).
+    shingler:               As for ShingleTable.
+
+    Shingles must be strings (see check_string_shingles).
+    '''
+    check_string_shingles(shingler)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    run_dir = tempfile.mkdtemp(prefix = 'shingle_runs_', dir = tmp_dir)
+    try:
+        doc_ids, shingle_sorter = _sort_shingles(shingle_record_iter, memory_budget, run_dir)
+        inverted_sorter = _write_postings(shingle_sorter.sorted_records(), path, memory_budget, run_dir)
+        _write_inverted(inverted_sorter.sorted_records(), len(doc_ids), path)
+        write_header(path, dict(doc_ids = doc_ids, shingler = shingler_config(shingler)))
+
+    finally:
+        shutil.rmtree(run_dir, ignore_errors = True)
+
+    return MappedShingleTable(path, shingler = shingler)
+
+def _sort_shingles(shingle_records, memory_budget, run_dir):
+
+    doc_ids = []
+    doc_indices = {}
+    sorter = ExternalSorter(memory_budget, run_dir, record_size = lambda record: sys.getsizeof(record[0]) + RECORD_OVERHEAD)
+    for shingle_record in shingle_records:
+        if not doc_ids:
+            check_string_shingles(shingle = shingle_record.shingle)
+        doc_index = doc_indices.get(shingle_record.doc_id)
+        if doc_index is None:
+            doc_index = doc_indices[shingle_record.doc_id] = len(doc_ids)
+            doc_ids.append(shingle_record.doc_id)
+        sorter.add( (shingle_record.shingle, doc_index, shingle_record.i) )
+
+    return doc_ids, sorter
+
+def _write_postings(sorted_shingle_records, path, memory_budget, run_dir):
+
+    shingles = StringsWriter(path, 'shingles')
+    offsets = ArrayWriter(path, 'posting_offsets', OFFSET_TYPECODE)
+    docs = ArrayWriter(path, 'posting_docs', POSTING_TYPECODE)
+    positions = ArrayWriter(path, 'posting_positions', POSTING_TYPECODE)
+    inverted_sorter = ExternalSorter(memory_budget, run_dir, record_size = lambda record: RECORD_OVERHEAD)
+
+    offsets.append(0)
+    for shingle, records in groupby(sorted_shingle_records, key = itemgetter(0)):
+        postings = _unique_sorted( (doc_index, i) for (_, doc_index, i) in records )
+        if len(postings) < 2:
+            continue
+
+        shingle_id = len(shingles)
+        shingles.append(shingle)
+        for doc_index, i in postings:
+            docs.append(doc_index)
+            positions.append(i)
+            inverted_sorter.add( (doc_index, i, shingle_id) )
+        offsets.append(len(docs))
+
+    for writer in (shingles, offsets, docs, positions):
+        writer.close()
+
+    return inverted_sorter
+
+def _unique_sorted(sorted_items):
+
+    unique = []
+    for item in sorted_items:
+        if not unique or unique[-1] != item:
+            unique.append(item)
+
+    return unique
+
+def _write_inverted(sorted_inverted_records, n_docs, path):
+
+    offsets = ArrayWriter(path, 'inverted_offsets', OFFSET_TYPECODE)
+    shingle_ids = ArrayWriter(path, 'inverted_shingle_ids', POSTING_TYPECODE)
+    positions = ArrayWriter(path, 'inverted_positions', POSTING_TYPECODE)
+
+    offsets.append(0)
+    for doc_index, i, shingle_id in sorted_inverted_records:
+        while len(offsets) <= doc_index:        # close the lists of the documents before this one
+            offsets.append(len(shingle_ids))
+        shingle_ids.append(shingle_id)
+        positions.append(i)
+
+    while len(offsets) <= n_docs:
+        offsets.append(len(shingle_ids))
+
+    for writer in (offsets, shingle_ids, positions):
+        writer.close()
+
+
+class ExternalSorter(object):
+
+    def __init__(self, memory_budget, run_dir, record_size, max_fan_in = MAX_MERGE_FAN_IN):
+        '''
+        Sorts marshalable records (tuples of strings and ints) that may not fit in memory. Records
+        are buffered until their estimated size (record_size(record) bytes each) exceeds
+        memory_budget, then sorted and spilled to a run in run_dir; sorted_records() k-way
+        merges the runs with whatever is still buffered. While there are more than max_fan_in
+        runs, groups of max_fan_in runs are first merged into longer ones, so that no more than
+        max_fan_in run files are ever open at once.
+        '''
+        if max_fan_in < 2:
+            raise ValueError('max_fan_in must be at least 2, got {0!r}.'.format(max_fan_in))
+
+        self._memory_budget = memory_budget
+        self._run_dir = run_dir
+        self._record_size = record_size
+        self._max_fan_in = max_fan_in
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._run_paths = []
+
+    def add(self, record):
+
+        self._buffer.append(record)
+        self._buffered_bytes += self._record_size(record)
+        if self._buffered_bytes >= self._memory_budget:
+            self._spill()
+
+    def _spill(self):
+
+        self._buffer.sort()
+        self._run_paths.append(self._write_run(self._buffer))
+        self._buffer = []
+        self._buffered_bytes = 0
+
+    def _write_run(self, sorted_records):
+
+        run_file, run_path = tempfile.mkstemp(dir = self._run_dir)
+        with os.fdopen(run_file, 'wb') as run:
+            block = []
+            for record in sorted_records:
+                block.append(record)
+                if len(block) >= SPILL_BLOCK_SIZE:
+                    marshal.dump(block, run)
+                    block = []
+            if block:
+                marshal.dump(block, run)
+
+        return run_path
+
+    def _merge_runs(self):
+        # Each pass divides the number of runs by max_fan_in; a run left alone is carried over.
+
+        while len(self._run_paths) > self._max_fan_in:
+            run_paths, self._run_paths = self._run_paths, []
+            for start in xrange(0, len(run_paths), self._max_fan_in):
+                merged_paths = run_paths[start:start + self._max_fan_in]
+                if len(merged_paths) == 1:
+                    self._run_paths.extend(merged_paths)
+                    continue
+                self._run_paths.append(self._write_run(heapq.merge(*map(self._read_run, merged_paths))))
+                for run_path in merged_paths:
+                    os.remove(run_path)
+
+    def sorted_records(self):
+
+        self._buffer.sort()
+        self._merge_runs()
+        runs = [self._read_run(run_path) for run_path in self._run_paths]
+        return heapq.merge(self._buffer, *runs)
+
+    def _read_run(self, run_path):
+
+        with open(run_path, 'rb') as run:
+            while True:
+                try:
+                    block = marshal.load(run)
+                except EOFError:
+                    return
+                for record in block:
+                    yield record
@@ -0,0 +1,239 @@
+import marshal
+import os
+import shutil
+import tempfile
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from Queue import Queue
+
+from shingle_table import ShingleTable, merge_shingle_tables
+from shingler import SHINGLE_KEY_TOKEN_IDS
+
+# Shinglers hold lambdas and bound methods, which cannot be pickled, and shingle tables are far
+# too large to send with every task. Pools are therefore created after this module level state is
+# set, and the forked workers inherit it (copy on write) instead of receiving it per task.
+_worker_state = {}
+
+
+# Table construction
+
+def build_shingle_table_parallel(doc_record_iter, shingler, processes = None, shard_size = 1000,
+                                 n_partitions = None, spill_dir = None, max_df = None, keep_stop_shingles = False):
+    '''
+    Builds the same ShingleTable as ShingleTable(shingler.shingle_docs(doc_record_iter)) on a
+    process pool, in two phases:
+
+    map:      DocRecords are cut into shards of shard_size documents. Each worker shingles a shard
+              into an unpurged partial table, splits it into n_partitions by shingle hash and
+              spills the partitions to disk.
+    reduce:   Each worker merges every shard's spill for one partition and purges the uniques.
+              Only shared shingles travel back to this process, where the disjoint partitions are
+              combined.
+
+    processes:      Pool size (default: cpu_count()).
+    shard_size:     Number of documents per map task.
+    n_partitions:   Number of reduce tasks (default: 4 * processes).
+    spill_dir:      Directory for the temporary map output (default: the system temp directory).
+    max_df, keep_stop_shingles:     As for ShingleTable. A shingle's bucket is complete within its
+                                    partition, so stop shingles are removed by the reduce workers.
+
+    Token id shingles are assigned per Shingler instance, and each worker would assign its own, so
+    only shinglers with process independent keys are accepted.
+    '''
+    if shingler.shingle_key == SHINGLE_KEY_TOKEN_IDS:
+        raise ValueError('Token id shingles cannot be built in parallel, every worker would assign different ids.')
+
+    processes = processes or cpu_count()
+    n_partitions = n_partitions or 4 * processes
+    tmp_dir = tempfile.mkdtemp(prefix = 'shingle_table_', dir = spill_dir)
+
+    _worker_state.update(shingler = shingler, n_partitions = n_partitions, tmp_dir = tmp_dir,
+                         max_df = max_df, keep_stop_shingles = keep_stop_shingles)
+    pool = Pool(processes)
+    try:
+        shards = enumerate(_shards(doc_record_iter, shard_size))
+        shard_doc_counts = list(_imap_bounded(pool, _map_shard, shards, max_pending = 2 * processes))
+        n_shards, n_docs = len(shard_doc_counts), sum(shard_doc_counts)
+
+        # The workers were forked before n_shards was known, so it travels with the task.
+        shingle_table = ShingleTable((), purge_uniques = False, max_df = max_df, keep_stop_shingles = keep_stop_shingles)
+        partitions = ((partition, n_shards, n_docs) for partition in xrange(n_partitions))
+        for partition_table in _imap_bounded(pool, _reduce_partition, partitions, max_pending = 2 * processes):
+            _add_partition(shingle_table, partition_table)
+
+        pool.close()
+        pool.join()
+
+    finally:
+        pool.terminate()
+        _worker_state.clear()
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    shingle_table.shingler = shingler
+    return shingle_table
+
+def _shards(doc_record_iter, shard_size):
+
+    doc_record_iter = iter(doc_record_iter)
+    while True:
+        shard = list(islice(doc_record_iter, shard_size))
+        if not shard:
+            return
+        yield shard
+
+def _spill_path(shard_index, partition):
+    return os.path.join(_worker_state['tmp_dir'], 'shard-{0}-{1}'.format(shard_index, partition))
+
+def _map_shard(task):
+
+    shard_index, doc_records = task
+    shingler = _worker_state['shingler']
+    n_partitions = _worker_state['n_partitions']
+
+    partial_table = ShingleTable(shingler.shingle_docs(doc_records), purge_uniques = False)
+    partitions = [{} for _ in xrange(n_partitions)]
+    for shingle, bucket in partial_table.iteritems():
+        partitions[hash(shingle) % n_partitions][shingle] = bucket
+
+    for partition, partition_table in enumerate(partitions):
+        with open(_spill_path(shard_index, partition), 'wb') as spill_file:
+            marshal.dump(partition_table, spill_file)
+
+    return partial_table.n_docs
+
+def _reduce_partition(task):
+
+    partition, n_shards, n_docs = task
+    return merge_shingle_tables(
+                                   _load_spills(partition, n_shards),
+                                   max_df = _worker_state['max_df'],
+                                   keep_stop_shingles = _worker_state['keep_stop_shingles'],
+                                   n_docs = n_docs
+                               )
+
+def _load_spills(partition, n_shards):
+
+    for shard_index in xrange(n_shards):
+        with open(_spill_path(shard_index, partition), 'rb') as spill_file:
+            yield marshal.load(spill_file)
+
+def _add_partition(shingle_table, partition_table):
+    # Partitions hold disjoint shingles, so their buckets, stop shingles and counts simply add up.
+
+    shingle_table.update(partition_table)
+    shingle_table.stop_shingles.update(partition_table.stop_shingles)
+    for key, value in partition_table.build_stats.iteritems():
+        if key.startswith('n_') and key != 'n_docs':
+            value += shingle_table.build_stats.get(key, 0)
+        shingle_table.build_stats[key] = value
+
+
+# Sequence generation
+
+def generate_common_sequences_parallel(common_sequence_generator, doc_ids, processes = None, chunk_size = 16,
+                                       max_pending = None, ordered = True):
+    '''
+    Runs common_sequence_generator.generate_common_sequences for every doc_id on a process pool
+    and yields (doc_id, sequence_groups) pairs as they complete.
+
+    The generator, and with it the shingle table and inverted table, reaches the workers by fork
+    and is never pickled. Forked pages are shared copy on write; reference counting gradually
+    dirties pages of in-memory tables, so for very large corpora prefer a MappedShingleTable,
+    whose pages stay shared through the page cache.
+
+    doc_ids:        Iterable of doc ids. It is consumed lazily, at most max_pending chunks ahead
+                    of the results that have been yielded (backpressure).
+    processes:      Pool size (default: cpu_count()).
+    chunk_size:     Number of doc ids per task.
+    max_pending:    Maximum number of chunks in flight (default: 2 * processes).
+    ordered:        Yield results in doc_ids order. Otherwise chunks are yielded as they complete.
+
+    Documents without any shared shingle (see CommonSequenceGenerator.has_shared_shingles) yield 
+    an empty list instead of raising KeyError, so a single such document does not abort the batch.
+    '''
+    processes = processes or cpu_count()
+    max_pending = max_pending or 2 * processes
+
+    _worker_state.update(generator = common_sequence_generator)
+    pool = Pool(processes)
+    try:
+        chunks = _shards(doc_ids, chunk_size)
+        for chunk_results in _imap_bounded(pool, _generate_chunk, chunks, max_pending, ordered):
+            for doc_id, sequence_groups in chunk_results:
+                yield doc_id, sequence_groups
+
+        pool.close()
+        pool.join()
+
+    finally:
+        pool.terminate()
+        _worker_state.clear()
+
+def _generate_chunk(doc_ids):
+
+    generator = _worker_state['generator']
+    return [(doc_id, _generate_doc(generator, doc_id)) for doc_id in doc_ids]
+
+def _generate_doc(generator, doc_id):
+
+    if not generator.has_shared_shingles(doc_id):
+        return []
+
+    return generator.generate_common_sequences(doc_id)
+
+
+# Pool helpers
+
+def _imap_bounded(pool, fn, task_iter, max_pending, ordered = True):
+    '''
+    pool.imap / pool.imap_unordered that keep at most max_pending tasks in flight, so that
+    task_iter is only consumed as fast as results are collected (Pool.imap drains its input
+    eagerly).
+    '''
+    if ordered:
+        return _imap_bounded_ordered(pool, fn, task_iter, max_pending)
+
+    return _imap_bounded_unordered(pool, fn, task_iter, max_pending)
+
+def _imap_bounded_ordered(pool, fn, task_iter, max_pending):
+
+    pending = deque()
+    for task in task_iter:
+        pending.append(pool.apply_async(fn, (task,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+def _imap_bounded_unordered(pool, fn, task_iter, max_pending):
+
+    completed = Queue()
+    n_pending = 0
+    for task in task_iter:
+        pool.apply_async(_call_captured, (fn, task), callback = completed.put)
+        n_pending += 1
+        if n_pending >= max_pending:
+            yield _unwrap_captured(completed.get())
+            n_pending -= 1
+
+    while n_pending:
+        yield _unwrap_captured(completed.get())
+        n_pending -= 1
+
+def _call_captured(fn, task):
+    # apply_async only calls back on success, so failures are returned as values instead of 
+    # raised, to be re-raised in the parent rather than leave it waiting forever.
+    try:
+        return True, fn(task)
+    except Exception as e:
+        return False, e
+
+def _unwrap_captured(captured):
+
+    succeeded, value = captured
+    if not succeeded:
+        raise value
+
+    return value
@@ -0,0 +1,487 @@
+'''
+A query service around a loaded shingle table. The table is loaded once, the common sequence
+generator runs on a pool of forked workers, and clients send JSON lines over a local TCP socket:
+
+    python service.py --table path/to/saved_table --port 8642
+
+Documents sent as text are shingled with the shingler saved with the table (see Shingler.config);
+tables saved without one only answer doc_id queries.
+
+Requests (one JSON object per line, answered in order on each connection):
+
+    {"id": 1, "doc_id": 42}                                     generate_common_sequences(42)
+    {"id": 2, "doc": "some text", "target_doc_ids": [1, 7]}     find_common_sequences for a document
+                                                                outside the table (doc_id optional)
+    {"metrics": true}                                           latency percentiles and counters
+
+Responses: one {"id": ..., "group": {...}} line per SequenceGroup, then {"id": ..., "done": true,
+"n_groups": ..., "latency_ms": ...}, or a single {"id": ..., "error": "..."} line.
+
+Queries from all connections are micro-batched: a batch is dispatched to the pool when it holds
+max_batch_size queries or batch_window seconds after its first query arrived, whichever comes
+first, so a burst of small queries costs one round trip to a worker instead of one each.
+'''
+import argparse
+import json
+import SocketServer
+import socket
+import sys
+import threading
+from collections import deque
+from itertools import count
+from multiprocessing import Pool, cpu_count
+from Queue import Queue, Empty
+from timeit import default_timer
+
+from csg import CommonSequenceGenerator
+from dto import DocRecord
+from shingle_table import MappedShingleTable
+from stats import Stats
+
+DEFAULT_PORT = 8642
+
+# The generator reaches the workers by fork instead of being pickled per task, as in parallel.py, 
+# but through the pool initializer: each pool (and every worker it respawns) has its own service's 
+# generator, and this process's _worker_state is never set, so services do not share it.
+_worker_state = {}
+
+def _init_worker(generator):
+    _worker_state.update(generator = generator)
+
+
+def sequence_group_as_dict(group):
+    '''JSON serializable form of a SequenceGroup: its source span and its sequences.'''
+    return dict(span = list(group.span),
+                sequences = [dict(src_doc_id = seq.src_doc_id, src_position = seq.src_position,
+                                  target_doc_id = seq.target_doc_id, target_position = seq.target_position,
+                                  length = seq.length, target_length = seq.target_length)
+                             for seq in group.sequences])
+
+
+class LatencyTracker(object):
+
+    def __init__(self, window = 10000):
+        '''
+        Thread safe record of the last window latencies (in seconds), summarized as nearest rank
+        percentiles in milliseconds.
+        '''
+        self._latencies = deque(maxlen = window)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._count += 1
+
+    def percentile(self, q):
+        '''The q-th percentile (0 < q <= 100) of the recorded latencies in milliseconds, or None.'''
+        with self._lock:
+            latencies = sorted(self._latencies)
+
+        return _percentile(latencies, q)
+
+    def summary(self):
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+            n_recorded = self._count
+
+        return dict(count = n_recorded,
+                    p50_ms = _percentile(latencies, 50),
+                    p99_ms = _percentile(latencies, 99),
+                    max_ms = _percentile(latencies, 100))
+
+def _percentile(sorted_latencies, q):
+
+    if not sorted_latencies:
+        return None
+
+    rank = max(int(-(-q * len(sorted_latencies) // 100)), 1)         # ceil(q * n / 100)
+    return 1000.0 * sorted_latencies[rank - 1]
+
+
+class PendingQuery(object):
+
+    __slots__ = ('query', 'submitted', 'succeeded', 'result', 'latency', '_done')
+
+    def __init__(self, query):
+        '''A query submitted to a QueryService. wait() blocks until its result arrives.'''
+        self.query = query
+        self.submitted = default_timer()
+        self.succeeded = None
+        self.result = None          # list of group dicts, or the error message
+        self.latency = None
+        self._done = threading.Event()
+
+    def wait(self, timeout = None):
+
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def _complete(self, succeeded, result):
+
+        self.succeeded = succeeded
+        self.result = result
+        self.latency = default_timer() - self.submitted
+        self._done.set()
+
+
+class QueryService(object):
+
+    def __init__(self, common_sequence_generator, processes = None, max_batch_size = 16, batch_window = 0.002,
+                 max_pending = None, batch_timeout = 60.0, stats = None):
+        '''
+        Runs the queries of many client threads on a process pool, in micro-batches.
+
+        processes:          Pool size (default: cpu_count()).
+        max_batch_size:     Maximum number of queries per pool task.
+        batch_window:       Seconds a batch waits for more queries after its first one.
+        max_pending:        Maximum number of batches in flight (default: 2 * processes). Further
+                            queries queue up in this process.
+        batch_timeout:      Seconds after which the queries of a batch still running fail (e.g. 
+                            when its worker died), releasing its slot.
+        stats:              Optional stats.Stats counting queries and batches, with a histogram
+                            of the batch sizes.
+
+        start() forks the pool, so call it before starting other threads. Latency percentiles are
+        in self.latencies, measured from submit() to the result being available.
+        '''
+        if max_batch_size < 1:
+            raise ValueError('max_batch_size must be at least 1, got {0!r}.'.format(max_batch_size))
+
+        self._generator = common_sequence_generator
+        self._processes = processes or cpu_count()
+        self._max_batch_size = max_batch_size
+        self._batch_window = batch_window
+        self._pending_batches = threading.BoundedSemaphore(max_pending or 2 * self._processes)
+        self._batch_timeout = batch_timeout
+        self._stats = stats
+        self._queries = Queue()
+        self._dispatched = Queue()          # (batch, AsyncResult, deadline) in dispatch order
+        self._n_lost_batches = 0
+        self._finish_lock = threading.Lock()
+        self._pool = None
+        self._batcher = None
+        self._reaper = None
+        self.latencies = LatencyTracker()
+
+    def start(self):
+
+        self._pool = Pool(self._processes, initializer = _init_worker, initargs = (self._generator,))
+        self._batcher = threading.Thread(target = self._dispatch_batches, name = 'query-batcher')
+        self._reaper = threading.Thread(target = self._reap_batches, name = 'query-reaper')
+        for thread in (self._batcher, self._reaper):
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def close(self):
+        '''Finishes the queries already submitted, then stops the batcher and the pool.'''
+        if self._batcher is not None:
+            self._queries.put(None)
+            self._batcher.join()
+            self._batcher = None
+            self._dispatched.put(None)
+            self._reaper.join()
+            self._reaper = None
+
+        if self._pool is not None:
+            # Every batch has finished or failed by now, but the pool would wait forever for a 
+            # lost one.
+            self._pool.close()
+            if self._n_lost_batches:
+                self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def submit(self, query):
+        '''
+        Queues a query dict, with either doc_id (a document of the table) or doc (the text of any
+        document, with an optional doc_id), and optional target_doc_ids. Returns a PendingQuery.
+        Documents without any shared shingle, like unknown doc ids, have no groups.
+        '''
+        if 'doc' not in query and 'doc_id' not in query:
+            raise ValueError('A query needs doc_id or doc.')
+
+        pending = PendingQuery(query)
+        self._queries.put(pending)
+        return pending
+
+    def query(self, query, timeout = None):
+        '''submit() and wait: returns the list of group dicts, or raises ValueError with the error.'''
+        pending = self.submit(query)
+        if not pending.wait(timeout):
+            raise ValueError('Query timed out.')
+        if not pending.succeeded:
+            raise ValueError(pending.result)
+
+        return pending.result
+
+    def metrics(self):
+
+        metrics = dict(latency = self.latencies.summary(), queued = self._queries.qsize())
+        if self._stats is not None:
+            metrics.update(self._stats.as_dict())
+
+        return metrics
+
+    def _dispatch_batches(self):
+
+        stopping = False
+        while not stopping:
+            first = self._queries.get()
+            if first is None:
+                return
+
+            batch = [first]
+            deadline = default_timer() + self._batch_window
+            while len(batch) < self._max_batch_size:
+                try:
+                    pending = self._queries.get(timeout = max(deadline - default_timer(), 0))
+                except Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+
+            if self._stats is not None:
+                self._stats.increment('queries', len(batch))
+                self._stats.increment('batches')
+                self._stats.observe('batch_size', len(batch))
+
+            self._pending_batches.acquire()
+            batch = _Batch(batch)
+            async_result = self._pool.apply_async(_run_batch, ([pending.query for pending in batch.pending_queries],),
+                                                  callback = lambda results, batch = batch: self._finish_batch(batch, results))
+            self._dispatched.put( (batch, async_result, default_timer() + self._batch_timeout) )
+
+    def _reap_batches(self):
+        # apply_async only calls back on success. Batches whose task failed (e.g. a result that 
+        # could not be pickled) or never completes (a worker died) are failed here instead, in 
+        # dispatch order: all batches share one timeout, so their deadlines are ordered too.
+
+        while True:
+            dispatched = self._dispatched.get()
+            if dispatched is None:
+                return
+
+            batch, async_result, deadline = dispatched
+            async_result.wait(max(deadline - default_timer(), 0))
+            if not async_result.ready():
+                with self._finish_lock:
+                    self._n_lost_batches += 1
+                error = 'Query batch timed out after {0} seconds.'.format(self._batch_timeout)
+            elif not async_result.successful():
+                try:
+                    async_result.get()
+                except Exception as e:
+                    error = 'Query batch failed: {0}: {1}'.format(e.__class__.__name__, e)
+            else:
+                continue
+
+            self._finish_batch(batch, [(False, error)] * len(batch.pending_queries))
+
+    def _finish_batch(self, batch, results):
+        # Called by the pool on success and by the reaper on failure; a timed out batch may 
+        # still complete later, and is only finished once.
+
+        with self._finish_lock:
+            if batch.finished:
+                return
+            batch.finished = True
+
+        self._pending_batches.release()
+        for pending, (succeeded, result) in zip(batch.pending_queries, results):
+            pending._complete(succeeded, result)
+            self.latencies.record(pending.latency)
+
+
+class _Batch(object):
+
+    __slots__ = ('pending_queries', 'finished')
+
+    def __init__(self, pending_queries):
+        self.pending_queries = pending_queries
+        self.finished = False
+
+def _run_batch(queries):
+    # As parallel._call_captured: failures are returned as values rather than raised, per query 
+    # so that one bad query does not fail the others.
+
+    try:
+        generator = _worker_state['generator']
+        return [_run_query(generator, query) for query in queries]
+    except Exception as e:
+        return [(False, '{0}: {1}'.format(e.__class__.__name__, e))] * len(queries)
+
+def _run_query(generator, query):
+
+    target_doc_ids = query.get('target_doc_ids')
+    try:
+        if 'doc' in query:
+            groups = generator.find_common_sequences(DocRecord(query.get('doc_id'), query['doc']), target_doc_ids)
+        elif generator.has_shared_shingles(query['doc_id']):
+            groups = generator.generate_common_sequences(query['doc_id'], target_doc_ids)
+        else:
+            groups = []
+    except Exception as e:
+        return False, '{0}: {1}'.format(e.__class__.__name__, e)
+
+    return True, [sequence_group_as_dict(group) for group in groups]
+
+
+# Socket server
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, query_service, address = ('127.0.0.1', DEFAULT_PORT), request_timeout = None):
+        '''
+        Serves query_service (already started) to JSON lines clients on a TCP address, one thread
+        per connection. Port 0 binds any free port; the bound address is server_address.
+        '''
+        SocketServer.TCPServer.__init__(self, address, _QueryHandler)
+        self.query_service = query_service
+        self.request_timeout = request_timeout
+
+
+class _QueryHandler(SocketServer.StreamRequestHandler):
+
+    # Responses are buffered and flushed once per query, and sent without waiting for the ack of 
+    # the previous segment.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def handle(self):
+
+        for line in iter(self.rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                query = json.loads(line)
+                if not isinstance(query, dict):
+                    raise ValueError('A query must be a JSON object.')
+            except ValueError as e:
+                self._write(dict(error = 'Invalid query: {0}'.format(e)))
+            else:
+                if query.get('metrics'):
+                    self._write(dict(id = query.get('id'), metrics = self.server.query_service.metrics()))
+                else:
+                    self._answer(query)
+            self.wfile.flush()
+
+    def _answer(self, query):
+
+        query_id = query.get('id')
+        try:
+            pending = self.server.query_service.submit(query)
+        except ValueError as e:
+            self._write(dict(id = query_id, error = str(e)))
+            return
+
+        if not pending.wait(self.server.request_timeout):
+            self._write(dict(id = query_id, error = 'Query timed out.'))
+        elif not pending.succeeded:
+            self._write(dict(id = query_id, error = pending.result))
+        else:
+            for group in pending.result:
+                self._write(dict(id = query_id, group = group))
+            self._write(dict(id = query_id, done = True, n_groups = len(pending.result), latency_ms = 1000.0 * pending.latency))
+
+    def _write(self, response):
+        self.wfile.write(json.dumps(response) + '\n')
+
+
+class QueryClient(object):
+
+    def __init__(self, address = ('127.0.0.1', DEFAULT_PORT), timeout = None):
+        '''Blocking client for a QueryServer; one connection, one query at a time.'''
+        self._socket = socket.create_connection(address, timeout)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._rfile = self._socket.makefile('rb')
+        self._query_ids = count(1)
+
+    def query(self, doc_id = None, doc = None, target_doc_ids = None):
+        '''Returns the list of group dicts of the query, or raises ValueError with the server's error.'''
+        query = dict(id = next(self._query_ids))
+        for key, value in (('doc_id', doc_id), ('doc', doc), ('target_doc_ids', target_doc_ids)):
+            if value is not None:
+                query[key] = value
+
+        self._send(query)
+        groups = []
+        for response in self._responses():
+            if 'error' in response:
+                raise ValueError(response['error'])
+            if response.get('done'):
+                return groups
+            groups.append(response['group'])
+
+    def metrics(self):
+
+        self._send(dict(metrics = True))
+        return next(self._responses())['metrics']
+
+    def _send(self, query):
+        self._socket.sendall(json.dumps(query) + '\n')
+
+    def _responses(self):
+
+        for line in iter(self._rfile.readline, ''):
+            yield json.loads(line)
+        raise ValueError('Connection closed by the server.')
+
+    def close(self):
+        self._rfile.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def parse_args(args = None):
+
+    parser = argparse.ArgumentParser(description = 'Serve common sequence queries against a saved shingle table.')
+    parser.add_argument('--table', required = True, help = 'directory written by ShingleTable.save or CompactShingleTable.save')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = DEFAULT_PORT)
+    parser.add_argument('--processes', type = int, default = None)
+    parser.add_argument('--max-batch-size', type = int, default = 16)
+    parser.add_argument('--batch-window-ms', type = float, default = 2.0)
+    parser.add_argument('--min-length', type = int, default = 1)
+    parser.add_argument('--max-gap', type = int, default = 0)
+    return parser.parse_args(args)
+
+def main():
+
+    args = parse_args()
+    shingle_table = MappedShingleTable(args.table)
+    if shingle_table.shingler is None:
+        sys.stderr.write('The table was saved without a shingler configuration; doc queries will be rejected.\n')
+    generator = CommonSequenceGenerator(shingle_table, min_length = args.min_length, max_gap = args.max_gap)
+    query_service = QueryService(generator, processes = args.processes, max_batch_size = args.max_batch_size,
+                                 batch_window = args.batch_window_ms / 1000.0, stats = Stats())
+    with query_service:
+        server = QueryServer(query_service, (args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,15 @@
+import numbers
+import os
 from operator import itemgetter
-from itertools import imap
+from itertools import imap, izip
+from array import array
+from bisect import bisect_left
 from normalizers import BasicNormalizer
 from dto import DocRecord, ShingleRecord
+from shingler import Shingler, SHINGLE_KEY_STRING
+from sketches import CountMinSketch
+from stats import timed
+from table_store import write_header, read_header, write_array, StringsWriter, MappedArray, MappedStrings
 
 # parse
 # normalize
@@ -25,28 +33,195 @@ from dto import DocRecord, ShingleRecord
 # - write access (increment)
 # - hashable
 
+_dict_setdefault = dict.setdefault
+
+
+def shingler_config(shingler):
+    '''The Shingler.config() saved in a table's header, or None.'''
+    return shingler.config() if shingler is not None else None
+
+def check_string_shingles(shingler = None, shingle = None):
+    '''
+    Raises ValueError unless the shingles of shingler, and the sample shingle, are strings: the 
+    on-disk table format stores its shingle dictionary as text.
+    '''
+    if shingler is not None and shingler.shingle_key != SHINGLE_KEY_STRING:
+        raise ValueError('Saved tables need string shingles, got a shingler with shingle_key {0!r}.'.format(shingler.shingle_key))
+
+    if shingle is not None and not isinstance(shingle, basestring):
+        raise ValueError('Saved tables need string shingles, got a {0} shingle.'.format(shingle.__class__.__name__))
+
+
 class ShingleTable(dict):
 
-    def __init__(self, shingle_record_iter):
+    def __init__(self, shingle_record_iter, purge_uniques = True, max_df = None, keep_stop_shingles = False,
+                 retain_uniques = False, shingler = None, stats = None):
+        '''
+        shingle_record_iter:    Iterable of ShingleRecord objects.
+        purge_uniques:          Drop shingles seen only once. Partial tables that are later combined 
+                                with merge_shingle_tables must be built with purge_uniques = False.
+        max_df:                 Maximum document frequency of a shingle, either a number of documents 
+                                (int) or a fraction of the corpus (float in (0, 1]). Shingles found in 
+                                more documents (boilerplate, headers, disclaimers) are removed as stop 
+                                shingles, bounding bucket sizes and so the fan-out of sequence generation. 
+                                Applied together with purge_uniques.
+        keep_stop_shingles:     Keep removed stop shingles, with their document frequency, in 
+                                self.stop_shingles so they can be reported (they are never expanded).
+        retain_uniques:         Keep purged singletons (and every document's shingles) aside so that 
+                                documents can later be added and removed with add_documents and 
+                                remove_documents. The inversion is then maintained along with the 
+                                table: invert() returns the same, live mapping every time, so 
+                                generators built on the table see later updates. Not compatible with 
+                                max_df, whose cutoff depends on the whole corpus. The retained 
+                                singletons are also matched by CommonSequenceGenerator.find_common_sequences.
+        shingler:               The Shingler that produced shingle_record_iter, kept as self.shingler so 
+                                that external documents can be shingled the same way.
+        stats:                  Optional stats.Stats recording the table_add, table_purge and invert stages, 
+                                shingles_added, singletons_purged, stop_shingles, shared_shingles and 
+                                the bucket_size histogram of the shared shingles.
 
-        self._build_table(shingle_record_iter)
+        After the build, self.build_stats holds the corpus size, the number of shingles kept and 
+        purged and the effective max_df cutoff (in documents).
 
-    def _build_table(self, shingle_record_iter):
+        invert() is computed once and memoized until the table changes, so generators over an 
+        unchanged table share one inversion (which they must not modify). Changes through the 
+        dict interface invalidate it; a bucket modified in place requires invalidate_inversion().
+        '''
+        self._configure(max_df, keep_stop_shingles, retain_uniques)
+        self.shingler = shingler
+        self.stats = stats
+        self._build_table(shingle_record_iter, purge_uniques)
+
+    def _configure(self, max_df, keep_stop_shingles, retain_uniques = False):
+
+        # bool is an Integral, but max_df = True is not a document count.
+        is_count = isinstance(max_df, numbers.Integral) and not isinstance(max_df, bool)
+        if max_df is not None and not (isinstance(max_df, float) and 0 < max_df <= 1 or is_count and max_df >= 1):
+            raise ValueError('max_df must be a positive number of documents or a fraction in (0, 1], got {0!r}.'.format(max_df))
+
+        if max_df is not None and retain_uniques:
+            raise ValueError('max_df is not supported on tables with retain_uniques.')
+
+        self._max_df = max_df
+        self._keep_stop_shingles = keep_stop_shingles
+        self._retain_uniques = retain_uniques
+        self._doc_ids = set()
+        self._uniques = {}          # shingle -> (doc_id, i), purged singletons (retain_uniques only)
+        self._doc_shingles = {}     # doc_id -> [(shingle, i), ...], every shingle (retain_uniques only)
+        self._inverted = None       # maintained inversion (retain_uniques only)
+        self._inverted_cache = None # memoized inversion (otherwise)
+        self.stop_shingles = {}
+        self.build_stats = {}
+
+    def _build_table(self, shingle_record_iter, purge_uniques = True):
+
+        with timed(self.stats, 'table_add'):
+            self._add_shingles(shingle_records = shingle_record_iter)
+        if purge_uniques:
+            with timed(self.stats, 'table_purge'):
+                self._purge_uniques()
+                self._purge_stop_shingles()
+
+        if self._retain_uniques:
+            self._inverted = self._invert()
+        self._record_build_stats()
+
+    def _record_build_stats(self):
+
+        if self.stats is None:
+            return
+
+        self.stats.increment('singletons_purged', self.build_stats.get('n_purged_uniques', 0))
+        self.stats.increment('stop_shingles', self.build_stats.get('n_stop_shingles', 0))
+        self.stats.increment('shared_shingles', len(self))
+        for bucket in self.itervalues():
+            self.stats.observe('bucket_size', len(bucket))
+
+    @property
+    def n_docs(self):
+        '''Number of documents that contributed at least one shingle.'''
+        return self.build_stats.get('n_docs', len(self._doc_ids))
 
-        self._add_shingles(shingle_records = shingle_record_iter)
-        self._purge_uniques()
-        
     def _add_shingles(self, shingle_records):
 
+        self._inverted_cache = None
+        n_added = 0
         for shingle_record in shingle_records:
+            n_added += 1
+            self._doc_ids.add(shingle_record.doc_id)
+            if self._retain_uniques:
+                self._doc_shingles.setdefault(shingle_record.doc_id, []).append( (shingle_record.shingle, shingle_record.i) )
             self._add_shingle(
                                  doc_id = shingle_record.doc_id,
                                  i = shingle_record.i,
                                  shingle = shingle_record.shingle
                              )
 
+        if self.stats is not None:
+            self.stats.increment('shingles_added', n_added)
+
+    def postings(self, shingle):
+        '''
+        The occurrences of shingle: its bucket, a one element list for a retained singleton, or 
+        None if the shingle is unknown.
+        '''
+        bucket = self.get(shingle)
+        if bucket is None and shingle in self._uniques:
+            return [self._uniques[shingle]]
+
+        return bucket
+
     def invert(self):
 
+        if self._retain_uniques:
+            return self._inverted
+
+        if self._inverted_cache is None:
+            with timed(self.stats, 'invert'):
+                self._inverted_cache = self._invert()
+
+        return self._inverted_cache
+
+    def invalidate_inversion(self):
+        '''Drops the memoized inversion, e.g. after modifying a bucket in place.'''
+        self._inverted_cache = None
+
+    # dict mutators, invalidating the memoized inversion
+
+    def __setitem__(self, shingle, bucket):
+        self._inverted_cache = None
+        dict.__setitem__(self, shingle, bucket)
+
+    def __delitem__(self, shingle):
+        self._inverted_cache = None
+        dict.__delitem__(self, shingle)
+
+    def pop(self, *args):
+        self._inverted_cache = None
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._inverted_cache = None
+        return dict.popitem(self)
+
+    def setdefault(self, shingle, bucket = None):
+        self._inverted_cache = None
+        return dict.setdefault(self, shingle, bucket)
+
+    def update(self, *args, **kwargs):
+        self._inverted_cache = None
+        dict.update(self, *args, **kwargs)
+
+    def clear(self):
+        self._inverted_cache = None
+        dict.clear(self)
+
+    def __getstate__(self):
+        # The memoized inversion is not worth its size in a pickle.
+        return dict(self.__dict__, _inverted_cache = None)
+
+    def _invert(self):
+
         inverted = {}
         for shingle, bucket in self.iteritems():
             for (doc_id, i) in bucket:
@@ -54,21 +229,608 @@ class ShingleTable(dict):
 
         return self._sort_inverted(inverted)
 
+    def save(self, path):
+        '''
+        Writes the table in the on-disk format of CompactShingleTable.save, to be opened with 
+        MappedShingleTable(path).
+        '''
+        check_string_shingles(self.shingler, next(self.iterkeys(), None))
+        CompactShingleTable(self._records(), shingler = self.shingler).save(path)
+
+    def _records(self):
+
+        for shingle, bucket in self.iteritems():
+            for (doc_id, i) in bucket:
+                yield ShingleRecord(doc_id = doc_id, i = i, shingle = shingle)
+
     def _add_shingle(self, doc_id, i, shingle):
+        # Bypasses the invalidating setdefault (a Python level call per shingle): _add_shingles 
+        # has already invalidated.
 
-        self.setdefault(shingle, set()).add( (doc_id, i) )
+        _dict_setdefault(self, shingle, set()).add( (doc_id, i) )
+
+    def _merge(self, other):
+
+        self._inverted_cache = None
+        self._doc_ids.update(getattr(other, '_doc_ids', ()))
+        for shingle, other_bucket in other.iteritems():
+            bucket = self.get(shingle)
+            if bucket is None:
+                self[shingle] = set(other_bucket)
+            else:
+                bucket.update(other_bucket)
 
     def _purge_uniques(self):
 
+        self._inverted_cache = None
         purge_keys = [shingle for shingle, bucket in self.iteritems() if len(bucket) < 2]
         for shingle in purge_keys:
+            bucket = dict.pop(self, shingle)
+            if self._retain_uniques:
+                self._uniques[shingle] = bucket.pop()
+
+        self.build_stats.update(n_docs = len(self._doc_ids), n_purged_uniques = len(purge_keys), n_shingles = len(self))
+
+    def _purge_stop_shingles(self, n_docs = None):
+        # n_docs overrides the documents counted by this table, for tables merged from partial 
+        # tables that do not carry their doc ids.
+
+        n_docs = len(self._doc_ids) if n_docs is None else n_docs
+        cutoff = self._max_df_cutoff(n_docs)
+        self.build_stats.update(n_docs = n_docs, max_df_cutoff = cutoff, n_stop_shingles = 0)
+        if cutoff is None:
+            return
+
+        stop_shingles = {}
+        for shingle, bucket in self.iteritems():
+            if len(bucket) > cutoff:                # df <= len(bucket), so smaller buckets are safe
+                df = len(set(doc_id for (doc_id, i) in bucket))
+                if df > cutoff:
+                    stop_shingles[shingle] = df
+
+        for shingle in stop_shingles:
             self.pop(shingle)
 
+        if self._keep_stop_shingles:
+            self.stop_shingles.update(stop_shingles)
+        self.build_stats.update(n_stop_shingles = len(stop_shingles), n_shingles = len(self))
+
+    def _max_df_cutoff(self, n_docs):
+
+        if self._max_df is None:
+            return None
+
+        if isinstance(self._max_df, float):
+            return max(1, int(self._max_df * n_docs))
+
+        return self._max_df
+
+    # Incremental updates (retain_uniques only). Each costs O(size of the document) plus, for 
+    # every shingle that changes between unique and shared, an insertion into or removal from the 
+    # other document's inverted list.
+
+    def add_documents(self, shingle_record_iter):
+        '''
+        Adds the ShingleRecords of new documents. Shingles previously purged as unique come back 
+        once a second occurrence arrives.
+        '''
+        self._check_incremental()
+        added_doc_ids = set()
+        for shingle_record in shingle_record_iter:
+            doc_id = shingle_record.doc_id
+            if doc_id not in added_doc_ids:
+                if doc_id in self._doc_ids:
+                    raise ValueError('Document {0!r} is already in the table.'.format(doc_id))
+                added_doc_ids.add(doc_id)
+                self._doc_shingles[doc_id] = []
+                self._doc_ids.add(doc_id)
+
+            self._doc_shingles[doc_id].append( (shingle_record.shingle, shingle_record.i) )
+            self._add_incremental_shingle(doc_id, shingle_record.i, shingle_record.shingle)
+
+        self._update_build_stats()
+
+    def remove_documents(self, doc_ids):
+        '''
+        Removes documents. Shingles left with a single occurrence are purged as unique again.
+        '''
+        self._check_incremental()
+        for doc_id in doc_ids:
+            for shingle, i in self._doc_shingles.pop(doc_id):
+                self._remove_incremental_shingle(doc_id, i, shingle)
+
+            self._inverted.pop(doc_id, None)
+            self._doc_ids.discard(doc_id)
+
+        self._update_build_stats()
+
+    def _check_incremental(self):
+        if not self._retain_uniques:
+            raise ValueError('Incremental updates require a table built with retain_uniques = True.')
+
+    def _add_incremental_shingle(self, doc_id, i, shingle):
+
+        bucket = self.get(shingle)
+        if bucket is not None:
+            bucket.add( (doc_id, i) )
+            self._add_inverted(doc_id, shingle, i)
+            return
+
+        unique_posting = self._uniques.pop(shingle, None)
+        if unique_posting is None:
+            self._uniques[shingle] = (doc_id, i)
+            return
+
+        # Second occurrence: the shingle is shared again.
+        self[shingle] = set([unique_posting, (doc_id, i)])
+        self._add_inverted(unique_posting[0], shingle, unique_posting[1])
+        self._add_inverted(doc_id, shingle, i)
+
+    def _remove_incremental_shingle(self, doc_id, i, shingle):
+
+        bucket = self.get(shingle)
+        if bucket is None:
+            if self._uniques.get(shingle) == (doc_id, i):
+                del self._uniques[shingle]
+            return
+
+        bucket.discard( (doc_id, i) )
+        if len(bucket) > 1:
+            return
+
+        # Back to a single occurrence: purge it as unique.
+        del self[shingle]
+        other_doc_id, j = self._uniques[shingle] = bucket.pop()
+        if other_doc_id != doc_id:
+            self._remove_inverted(other_doc_id, shingle, j)
+
+    def _add_inverted(self, doc_id, shingle, i):
+
+        inv_bucket = self._inverted.setdefault(doc_id, [])
+        if not inv_bucket or inv_bucket[-1][1] < i:
+            inv_bucket.append( (shingle, i) )
+        else:
+            inv_bucket.insert(self._inverted_index(inv_bucket, i), (shingle, i))
+
+    def _remove_inverted(self, doc_id, shingle, i):
+
+        inv_bucket = self._inverted[doc_id]
+        del inv_bucket[self._inverted_index(inv_bucket, i)]
+        if not inv_bucket:
+            del self._inverted[doc_id]
+
+    def _inverted_index(self, inv_bucket, i):
+        # Leftmost index whose position is >= i (inverted buckets are sorted by position).
+
+        lo, hi = 0, len(inv_bucket)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if inv_bucket[mid][1] < i:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def _update_build_stats(self):
+        self.build_stats.update(n_docs = len(self._doc_ids), n_shingles = len(self))
+
     def _sort_inverted(self, inverted):
+        # Buckets are sets, so the order the shingler emitted positions in is lost and each 
+        # document's list has to be sorted once; in place, as the lists are fresh.
+
+        for inv_buckets in inverted.itervalues():
+            inv_buckets.sort(key = itemgetter(1))
+
+        return inverted
+
+
+def merge_shingle_tables(partial_tables, max_df = None, keep_stop_shingles = False, n_docs = None):
+    '''
+    Combines unpurged partial tables (shingle -> bucket mappings, e.g. ShingleTables built with 
+    purge_uniques = False over disjoint slices of the corpus) into one ShingleTable. Shingles are 
+    only purged as unique (and as stop shingles, see ShingleTable) after the merge, so the result 
+    is identical to a single serial build.
+
+    n_docs:     Corpus size for a fractional max_df, when the partial tables are plain mappings 
+                that do not count their documents.
+    '''
+    merged = ShingleTable((), purge_uniques = False, max_df = max_df, keep_stop_shingles = keep_stop_shingles)
+    for partial_table in partial_tables:
+        merged._merge(partial_table)
+    merged._purge_uniques()
+    merged._purge_stop_shingles(n_docs)
+
+    return merged
+
+
+class TwoPassShingleTable(ShingleTable):
+
+    def __init__(self, shingle_record_iter_factory, sketch_width = 2 ** 22, sketch_depth = 4,
+                 max_df = None, keep_stop_shingles = False, shingler = None, stats = None):
+        '''
+        ShingleTable built in two streaming passes so that buckets are only allocated for shingles 
+        seen at least twice. The first pass counts every shingle in a count-min sketch; the second 
+        only inserts shingles the sketch has seen more than once. The sketch never under-counts, so 
+        no shared shingle is lost, and the few singletons let through by collisions are removed by 
+        the usual purge. Peak memory is the shared shingle set plus width * depth bytes. The 
+        singletons held back by the sketch count as purged in build_stats and stats, as they would 
+        for a ShingleTable over the same records.
+
+        shingle_record_iter_factory:    Callable returning a fresh ShingleRecord iterator (e.g. 
+                                        lambda: shingler.shingle_docs(read_docs())). Called twice.
+        sketch_width:                   Counters per sketch row. Size it above the number of distinct shingles.
+        sketch_depth:                   Number of sketch rows.
+        max_df, keep_stop_shingles:     As for ShingleTable.
+        shingler, stats:                As for ShingleTable.
+        '''
+        self._configure(max_df, keep_stop_shingles)
+        self.shingler = shingler
+        self.stats = stats
+        self._sketch = CountMinSketch(width = sketch_width, depth = sketch_depth)
+        self._n_sketch_singletons = 0
+        self._build_table(shingle_record_iter_factory)
+
+    def _build_table(self, shingle_record_iter_factory):
+
+        with timed(self.stats, 'table_count'):
+            self._count_shingles(shingle_records = shingle_record_iter_factory())
+        with timed(self.stats, 'table_add'):
+            self._add_shingles(shingle_records = self._repeated_shingles(shingle_record_iter_factory()))
+        self._sketch = None
+        with timed(self.stats, 'table_purge'):
+            self._purge_uniques()
+            self._purge_stop_shingles()
+        self._record_build_stats()
+
+    def _count_shingles(self, shingle_records):
+
+        for shingle_record in shingle_records:
+            self._doc_ids.add(shingle_record.doc_id)
+            self._sketch.add(shingle_record.shingle)
+
+    def _repeated_shingles(self, shingle_records):
+
+        for shingle_record in shingle_records:
+            if self._sketch.estimate(shingle_record.shingle) > 1:
+                yield shingle_record
+            else:
+                self._n_sketch_singletons += 1
+
+    def _purge_uniques(self):
+        # Only the singletons let through by the sketch are left to purge here.
+
+        ShingleTable._purge_uniques(self)
+        self.build_stats['n_purged_uniques'] += self._n_sketch_singletons
+
+
+# Compact representation
+
+POSTING_TYPECODE = 'i'  # doc indices, positions and shingle ids
+OFFSET_TYPECODE = 'l'   # offsets into the flat posting arrays
+
+class CompactShingleTable(object):
+
+    def __init__(self, shingle_record_iter, shingler = None):
+        '''
+        Memory compact alternative to ShingleTable. Shingles are interned to integer ids (their 
+        rank in sorted order) and every bucket is stored as a sorted slice of two parallel int 
+        arrays, one of doc indices and one of positions.
+
+        compact_table[shingle_id]:  PostingList over the bucket, iterating (doc_id, i) like a ShingleTable bucket
+        compact_table.invert():     doc_id -> [(shingle_id_1, position_1), ..., (shingle_id_m, position_m)]
+        shingler:                   As for ShingleTable.
+        '''
+        self.shingler = shingler
+        self._build_table(shingle_record_iter)
+
+    def _build_table(self, shingle_record_iter):
+
+        staged_postings = self._stage_shingles(shingle_records = shingle_record_iter)
+        self._pack(staged_postings)
+
+    def _stage_shingles(self, shingle_records):
+
+        self._doc_ids = []
+        self._doc_indices = {}
+        staged_postings = {}
+        for shingle_record in shingle_records:
+            doc_index = self._intern_doc_id(shingle_record.doc_id)
+            postings = staged_postings.get(shingle_record.shingle)
+            if postings is None:
+                postings = staged_postings[shingle_record.shingle] = array(POSTING_TYPECODE)
+            postings.append(doc_index)
+            postings.append(shingle_record.i)
+
+        return staged_postings
+
+    def _intern_doc_id(self, doc_id):
+
+        doc_index = self._doc_indices.get(doc_id)
+        if doc_index is None:
+            doc_index = self._doc_indices[doc_id] = len(self._doc_ids)
+            self._doc_ids.append(doc_id)
+
+        return doc_index
+
+    def _pack(self, staged_postings):
+        # Shingles are visited in sorted order so that a shingle's id is its rank, which keeps
+        # the shingle -> id lookup a bisection over self._shingles rather than a second dict.
+
+        self._shingles = []
+        self._posting_offsets = array(OFFSET_TYPECODE, [0])
+        self._posting_docs = array(POSTING_TYPECODE)
+        self._posting_positions = array(POSTING_TYPECODE)
+        for shingle in sorted(staged_postings):
+            postings = self._unique_postings(staged_postings.pop(shingle))
+            if len(postings) < 2:
+                continue
+
+            self._shingles.append(shingle)
+            for doc_index, i in postings:
+                self._posting_docs.append(doc_index)
+                self._posting_positions.append(i)
+            self._posting_offsets.append(len(self._posting_docs))
+
+    def _unique_postings(self, flat_postings):
+        return sorted(set(zip(flat_postings[::2], flat_postings[1::2])))
+
+    @property
+    def doc_ids(self):
+        return self._doc_ids
+
+    def shingle(self, shingle_id):
+        return self._shingles[shingle_id]
+
+    def shingle_id(self, shingle):
+
+        shingle_id = bisect_left(self._shingles, shingle)
+        if shingle_id == len(self._shingles) or self._shingles[shingle_id] != shingle:
+            raise KeyError(shingle)
+
+        return shingle_id
+
+    def __len__(self):
+        return len(self._posting_offsets) - 1
+
+    def __iter__(self):
+        return iter(xrange(len(self)))
+
+    def __contains__(self, shingle_id):
+        return 0 <= shingle_id < len(self)
+
+    def __getitem__(self, shingle_id):
+
+        if shingle_id not in self:
+            raise KeyError(shingle_id)
+
+        return PostingList(
+                              table = self,
+                              start = self._posting_offsets[shingle_id],
+                              end = self._posting_offsets[shingle_id + 1]
+                          )
+
+    def iteritems(self):
+        for shingle_id in self:
+            yield shingle_id, self[shingle_id]
+
+    def postings(self, shingle):
+        '''The PostingList of shingle (the shingle itself, not its id), or None if it is not shared.'''
+
+        try:
+            return self[self.shingle_id(shingle)]
+        except KeyError:
+            return None
+
+    _inverted_table = None
+
+    def invert(self):
+        # Compact tables never change, so the inversion is built once.
+
+        if self._inverted_table is None:
+            offsets, shingle_ids, positions = self._invert_arrays()
+            self._inverted_table = InvertedTable(
+                                                    doc_ids = self._doc_ids,
+                                                    doc_indices = self._doc_indices,
+                                                    offsets = offsets,
+                                                    shingle_ids = shingle_ids,
+                                                    positions = positions
+                                                )
+
+        return self._inverted_table
+
+    def _invert_arrays(self):
+
+        inverted = [[] for _ in self._doc_ids]
+        for shingle_id in self:
+            start, end = self._posting_offsets[shingle_id], self._posting_offsets[shingle_id + 1]
+            for k in xrange(start, end):
+                inverted[self._posting_docs[k]].append( (self._posting_positions[k], shingle_id) )
+
+        return self._pack_inverted(inverted)
+
+    def _pack_inverted(self, inverted):
+
+        offsets = array(OFFSET_TYPECODE, [0])
+        shingle_ids = array(POSTING_TYPECODE)
+        positions = array(POSTING_TYPECODE)
+        for inv_bucket in inverted:
+            for i, shingle_id in sorted(inv_bucket):
+                shingle_ids.append(shingle_id)
+                positions.append(i)
+            offsets.append(len(shingle_ids))
+
+        return offsets, shingle_ids, positions
+
+    def save(self, path):
+        '''
+        Writes the table, and its inversion, to the directory path: the sorted shingle dictionary, 
+        the flat posting arrays with per-shingle offsets and the flat inverted arrays with 
+        per-document offsets. Open it with MappedShingleTable(path). Doc ids must be json 
+        serializable scalars (ints or strings), and shingles strings.
+        '''
+        check_string_shingles(self.shingler, self._shingles[0] if self._shingles else None)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        shingles_writer = StringsWriter(path, 'shingles')
+        for shingle in self._shingles:
+            shingles_writer.append(shingle)
+        shingles_writer.close()
+
+        write_array(path, 'posting_offsets', self._posting_offsets)
+        write_array(path, 'posting_docs', self._posting_docs)
+        write_array(path, 'posting_positions', self._posting_positions)
+
+        inverted_offsets, inverted_shingle_ids, inverted_positions = self._invert_arrays()
+        write_array(path, 'inverted_offsets', inverted_offsets)
+        write_array(path, 'inverted_shingle_ids', inverted_shingle_ids)
+        write_array(path, 'inverted_positions', inverted_positions)
+
+        write_header(path, dict(doc_ids = self._doc_ids, shingler = shingler_config(self.shingler)))
+
+
+class MappedShingleTable(CompactShingleTable):
+
+    def __init__(self, path, shingler = None):
+        '''
+        Opens a table written by CompactShingleTable.save (or ShingleTable.save) without reading it 
+        into memory: the shingle dictionary, the postings and the inverted table are memory mapped 
+        and decoded on access. Startup is independent of the corpus size (beyond the doc id list), 
+        and processes mapping the same table share its pages. Same interface as CompactShingleTable; 
+        invert() returns the stored inversion instead of recomputing it.
+
+        shingler:   As for ShingleTable. By default the table's shingler is rebuilt from the 
+                    configuration saved with it (see Shingler.config), if any; a shingler passed 
+                    here must have the same configuration.
+        '''
+        header = read_header(path)
+        saved_config = header.get('shingler')
+        if shingler is None and saved_config is not None:
+            shingler = Shingler.from_config(saved_config)
+        elif shingler is not None and saved_config is not None and shingler.config() not in (None, saved_config):
+            raise ValueError('The table at {0} was built with a different shingler: {1!r}.'.format(path, saved_config))
+        self.shingler = shingler
+        self._doc_ids = header['doc_ids']
+        self._doc_indices = dict( (doc_id, doc_index) for doc_index, doc_id in enumerate(self._doc_ids) )
+
+        self._shingles = MappedStrings(path, 'shingles')
+        self._posting_offsets = MappedArray(path, 'posting_offsets', OFFSET_TYPECODE)
+        self._posting_docs = MappedArray(path, 'posting_docs', POSTING_TYPECODE)
+        self._posting_positions = MappedArray(path, 'posting_positions', POSTING_TYPECODE)
+
+        self._inverted_arrays = (
+                                    MappedArray(path, 'inverted_offsets', OFFSET_TYPECODE),
+                                    MappedArray(path, 'inverted_shingle_ids', POSTING_TYPECODE),
+                                    MappedArray(path, 'inverted_positions', POSTING_TYPECODE),
+                                )
+
+    def _invert_arrays(self):
+        return self._inverted_arrays
+
+    def close(self):
+
+        self._shingles.close()
+        for mapped_array in (self._posting_offsets, self._posting_docs, self._posting_positions) + self._inverted_arrays:
+            mapped_array.close()
+
+
+class PostingList(object):
+    '''
+    Read only, set-like view of one bucket of a CompactShingleTable. Iterates (doc_id, i) 
+    tuples so that it can stand in for a ShingleTable bucket.
+    '''
+
+    __slots__ = ('_table', '_start', '_end')
+
+    def __init__(self, table, start, end):
+        self._table = table
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __iter__(self):
+
+        doc_ids = self._table._doc_ids
+        docs = self._table._posting_docs[self._start:self._end]
+        positions = self._table._posting_positions[self._start:self._end]
+        for doc_index, i in izip(docs, positions):
+            yield (doc_ids[doc_index], i)
+
+    def __contains__(self, posting):
+
+        doc_id, i = posting
+        doc_index = self._table._doc_indices.get(doc_id)
+        if doc_index is None:
+            return False
+
+        docs = self._table._posting_docs
+        positions = self._table._posting_positions
+        lo, hi = self._start, self._end
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if (docs[mid], positions[mid]) < (doc_index, i):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo < self._end and docs[lo] == doc_index and positions[lo] == i
+
+    def copy(self):
+        return set(self)
+
+    def __repr__(self):
+        return u'{class_}({postings})'.format(class_ = self.__class__.__name__, postings = list(self))
+
+
+class InvertedTable(object):
+    '''
+    Read only mapping doc_id -> [(shingle_id_1, position_1), ..., (shingle_id_m, position_m)] 
+    backed by flat arrays, as returned by CompactShingleTable.invert(). Documents without any 
+    shared shingle are absent, as in ShingleTable.invert().
+    '''
+
+    def __init__(self, doc_ids, doc_indices, offsets, shingle_ids, positions):
+        self._doc_ids = doc_ids
+        self._doc_indices = doc_indices
+        self._offsets = offsets
+        self._shingle_ids = shingle_ids
+        self._positions = positions
+
+    def _span(self, doc_index):
+        return self._offsets[doc_index], self._offsets[doc_index + 1]
+
+    def __getitem__(self, doc_id):
+
+        start, end = self._span(self._doc_indices[doc_id])
+        if start == end:
+            raise KeyError(doc_id)
+
+        return zip(self._shingle_ids[start:end], self._positions[start:end])
+
+    def __contains__(self, doc_id):
+
+        doc_index = self._doc_indices.get(doc_id)
+        if doc_index is None:
+            return False
+
+        start, end = self._span(doc_index)
+        return start < end
+
+    def __iter__(self):
+        for doc_index, doc_id in enumerate(self._doc_ids):
+            start, end = self._span(doc_index)
+            if start < end:
+                yield doc_id
 
-        inverted_sorted = {}
-        for doc_id, inv_buckets in inverted.iteritems():
-            inverted_sorted[doc_id] = sorted( inv_buckets, key = itemgetter(1) )
+    def __len__(self):
+        return sum(1 for _ in self)
 
-        return inverted_sorted
+    def keys(self):
+        return list(self)
 
+    def iteritems(self):
+        for doc_id in self:
+            yield doc_id, self[doc_id]
@@ -1,26 +1,136 @@
+from array import array
 from itertools import imap
 import re
 
 from dto import ShingleRecord
+from normalizers import NORMALIZERS
+from stats import timed
+
+# Shingle keys
+SHINGLE_KEY_STRING = 'string'          # u' '.join of the shingle's normalized tokens
+SHINGLE_KEY_TOKEN_IDS = 'token_ids'    # tuple of the ids of the shingle's normalized tokens
+SHINGLE_KEY_HASH = 'hash'              # 64 bit Rabin-Karp rolling hash of the shingle's normalized tokens
+SHINGLE_KEYS = (SHINGLE_KEY_STRING, SHINGLE_KEY_TOKEN_IDS, SHINGLE_KEY_HASH)
+
+UNSEEN_TOKEN_ID = -1                   # id of a token not in the vocabulary, at query time
+
+HASH_BASE = 0x100000001b3
+HASH_MASK = 2 ** 64 - 1
+
+OFFSET_TYPECODE = 'i'                  # token character offsets
 
 class Shingler(object):
 
-    def __init__(self, shingle_size, normalization_fn, token_ptrn = r"(?u)\b\w\w+\b"):
+    def __init__(self, shingle_size, normalization_fn, token_ptrn = r"(?u)\b\w\w+\b",
+                 normalization_cache_size = 100000, shingle_key = SHINGLE_KEY_STRING, keep_tokens = False,
+                 record_offsets = False, stats = None):
         '''
-        shingle_size:       Number of tokens per shingle (after normalization / filtering)
-        normalization_fn:   Function taking a string and returning the normalized version.
-                            The normlization function is applied to each token after tokenization. If a raw 
-                            token is normalized to the empty string, it is removed from the token sequence.
-        token_ptrn:         Regular expression that defines a token. 
+        shingle_size:               Number of tokens per shingle (after normalization / filtering)
+        normalization_fn:           Function taking a string and returning the normalized version.
+                                    The normlization function is applied to each token after tokenization. If a raw 
+                                    token is normalized to the empty string, it is removed from the token sequence.
+        token_ptrn:                 Regular expression that defines a token. 
+        normalization_cache_size:   Number of raw token -> normalized token results to memoize (normalization_fn 
+                                    must be deterministic). The cache is emptied when full. 0 disables it.
+        shingle_key:                One of SHINGLE_KEYS. Token id tuples avoid building a new string per shingle, 
+                                    but ids are assigned by this Shingler instance as tokens are first seen, so 
+                                    every document of a table must go through the same instance (and process).
+                                    Hashes cost O(1) per position and are the same in every process, but distinct 
+                                    shingles may collide (see CommonSequenceGenerator's verify_shingles).
+        keep_tokens:                Keep the normalized tokens of every document shingled by shingle_doc in 
+                                    doc_tokens (doc_id -> list of tokens), e.g. to verify hashed shingles. 
+        record_offsets:             Keep the character offsets of the kept tokens of every document shingled by 
+                                    shingle_doc in token_offsets (doc_id -> array [start_0, end_0, start_1, ...]), 
+                                    so that sequences can be mapped back to the source text (see spans.SpanResolver).
+        stats:                      Optional stats.Stats recording docs_shingled, tokens, shingles and 
+                                    normalization_cache_misses, and the time spent in the tokenize stage.
         '''
+        if shingle_key not in SHINGLE_KEYS:
+            raise ValueError('Unknown shingle_key {0!r}, expected one of {1}.'.format(shingle_key, SHINGLE_KEYS))
+
+        self.token_ptrn = token_ptrn
         compiled_token_ptrn = re.compile(token_ptrn)
         self._tokenizer = lambda s: compiled_token_ptrn.findall(s)
+        self._token_matcher = lambda s: compiled_token_ptrn.finditer(s)
         self._shingle_size = shingle_size
         self._normalization_fn = normalization_fn
+        self._normalization_cache_size = normalization_cache_size
+        self._normalization_cache = {}
+        self._n_normalization_cache_misses = 0
+        self.shingle_key = shingle_key
+        self._token_ids = {}
+        self.doc_tokens = {} if keep_tokens else None
+        self.token_offsets = {} if record_offsets else None
+        self.stats = stats
+
+    @property
+    def shingle_size(self):
+        return self._shingle_size
+
+    def config(self):
+        '''
+        json serializable settings from which from_config rebuilds a Shingler producing the same 
+        shingles, or None if normalization_fn is not the normalize method of one of 
+        normalizers.NORMALIZERS.
+        '''
+        normalizer = getattr(self._normalization_fn, '__self__', None)
+        normalizer_name = getattr(normalizer, 'name', None)
+        if normalizer_name not in NORMALIZERS or type(normalizer) is not NORMALIZERS[normalizer_name]:
+            return None
+
+        return dict(shingle_size = self._shingle_size, token_ptrn = self.token_ptrn, shingle_key = self.shingle_key,
+                    normalizer = normalizer_name)
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        '''The Shingler of a config() dict; kwargs are passed on (e.g. record_offsets).'''
+        return cls(config['shingle_size'], NORMALIZERS[config['normalizer']]().normalize, token_ptrn = config['token_ptrn'],
+                   shingle_key = config['shingle_key'], **kwargs)
 
     def _tokenize(self, doc):
         return self._tokenizer(doc)
 
+    def normalized_tokens(self, doc):
+        '''Returns the list of non empty normalized tokens of doc, the sequence shingles are cut from.'''
+
+        n_misses = self._n_normalization_cache_misses
+        normalized_tokens = filter(None, imap(self._normalize, self._tokenize(doc)))
+        if self.stats is not None:
+            self.stats.increment('normalization_cache_misses', self._n_normalization_cache_misses - n_misses)
+
+        return normalized_tokens
+
+    def normalized_tokens_with_offsets(self, doc):
+        '''
+        Returns normalized_tokens(doc) along with an array of the character offsets of those 
+        tokens in doc, flattened as [start_0, end_0, start_1, end_1, ...].
+        '''
+        normalized_tokens = []
+        offsets = array(OFFSET_TYPECODE)
+        for match in self._token_matcher(doc):
+            normalized_token = self._normalize(match.group())
+            if normalized_token:
+                normalized_tokens.append(normalized_token)
+                offsets.append(match.start())
+                offsets.append(match.end())
+
+        return normalized_tokens, offsets
+
+    def _normalize(self, token):
+        # The one lookup into the bounded normalization cache, for every tokenizing path.
+
+        if not self._normalization_cache_size:
+            return self._normalization_fn(token)
+
+        normalized_token = self._normalization_cache.get(token)
+        if normalized_token is None:
+            if len(self._normalization_cache) >= self._normalization_cache_size:
+                self._normalization_cache.clear()
+            normalized_token = self._normalization_cache[token] = self._normalization_fn(token)
+            self._n_normalization_cache_misses += 1
+
+        return normalized_token
+
     def shingle_doc(self, doc_record):
         '''
         Takes a document (in the form of a DocRecord) and generates the shingles as defined by
@@ -28,19 +138,89 @@ class Shingler(object):
         objects (named tuples: shingle_record.doc_id) 
         doc_record: a DocRecord object (doc_record.doc_id, doc_record.doc) 
         '''
-        tokens = self._tokenize(doc_record.doc)
-        tokens = imap(self._normalization_fn, tokens)
-        tokens = filter(None, tokens)
-        n_tokens = len(tokens)
-        for i in xrange(n_tokens - self._shingle_size + 1):
-            shingle = u' '.join(tokens[i:(i+self._shingle_size)])
+        with timed(self.stats, 'tokenize'):
+            if self.token_offsets is not None:
+                tokens, self.token_offsets[doc_record.doc_id] = self.normalized_tokens_with_offsets(doc_record.doc)
+            else:
+                tokens = self.normalized_tokens(doc_record.doc)
+        if self.stats is not None:
+            self.stats.increment('docs_shingled')
+            self.stats.increment('tokens', len(tokens))
+            self.stats.increment('shingles', max(0, len(tokens) - self._shingle_size + 1))
+        if self.doc_tokens is not None:
+            self.doc_tokens[doc_record.doc_id] = tokens
+
+        for shingle_record in self.shingle_tokens(doc_record.doc_id, tokens):
+            yield shingle_record
+
+    def shingle_tokens(self, doc_id, tokens, assign_token_ids = True):
+        '''
+        Generates the ShingleRecords of a document from its normalized tokens (see normalized_tokens).
+
+        assign_token_ids:   With SHINGLE_KEY_TOKEN_IDS, give tokens seen for the first time a new id. 
+                            Queries pass False so that the vocabulary does not grow with them: unseen 
+                            tokens get UNSEEN_TOKEN_ID, and shingles containing one match nothing.
+        '''
+        if self.shingle_key == SHINGLE_KEY_TOKEN_IDS:
+            shingles = self._token_id_shingles(tokens, assign_token_ids)
+        elif self.shingle_key == SHINGLE_KEY_HASH:
+            shingles = self._hash_shingles(tokens)
+        else:
+            shingles = self._string_shingles(tokens)
+
+        for i, shingle in enumerate(shingles):
             yield ShingleRecord(
-                    doc_id = doc_record.doc_id, 
+                    doc_id = doc_id, 
                     i = i,
                     shingle = shingle
                 )
 
+    def _string_shingles(self, tokens):
+        # Joins the document once and slices every shingle out of it, instead of joining a new 
+        # list slice per shingle. The slices are identical to u' '.join(tokens[i:i+shingle_size]).
+
+        n_shingles = len(tokens) - self._shingle_size + 1
+        if n_shingles < 1:
+            return
+
+        joined = u' '.join(tokens)
+        starts = [0]
+        for token in tokens:
+            starts.append(starts[-1] + len(token) + 1)
+
+        for i in xrange(n_shingles):
+            yield joined[starts[i]:(starts[i+self._shingle_size] - 1)]
+
+    def _token_id_shingles(self, tokens, assign_token_ids = True):
+
+        token_ids = self._token_ids
+        if assign_token_ids:
+            ids = [token_ids.setdefault(token, len(token_ids)) for token in tokens]
+        else:
+            ids = [token_ids.get(token, UNSEEN_TOKEN_ID) for token in tokens]
+        for i in xrange(len(ids) - self._shingle_size + 1):
+            yield tuple(ids[i:(i+self._shingle_size)])
+
+    def _hash_shingles(self, tokens):
+        # h(t_i .. t_i+k-1) = sum(hash(t_i+j) * HASH_BASE ** (k-1-j)) mod 2 ** 64, rolled forward one 
+        # token at a time by removing the leading token's term and appending the next token.
+
+        if len(tokens) < self._shingle_size:
+            return
+
+        token_hashes = [hash(token) & HASH_MASK for token in tokens]
+        leading_factor = pow(HASH_BASE, self._shingle_size - 1, HASH_MASK + 1)
+        shingle_hash = 0
+        for token_hash in token_hashes[:self._shingle_size]:
+            shingle_hash = (shingle_hash * HASH_BASE + token_hash) & HASH_MASK
+        yield shingle_hash
+
+        for i in xrange(self._shingle_size, len(token_hashes)):
+            shingle_hash -= token_hashes[i - self._shingle_size] * leading_factor
+            shingle_hash = (shingle_hash * HASH_BASE + token_hashes[i]) & HASH_MASK
+            yield shingle_hash
+
     def shingle_docs(self, doc_record_iter):
         for doc_record in doc_record_iter:
             for shingle_record in self.shingle_doc(doc_record):
-                yield shingle_record
\ No newline at end of file
+                yield shingle_record
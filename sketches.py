@@ -0,0 +1,164 @@
+import random
+from array import array
+from itertools import groupby, izip
+from operator import attrgetter
+
+
+class CountMinSketch(object):
+
+    def __init__(self, width, depth):
+        '''
+        width:  Number of counters per row. Collisions (and so over-estimates) become rare once 
+                width is well above the number of distinct items added.
+        depth:  Number of rows, i.e. independent hash functions. The estimate is the minimum over rows.
+
+        Counters are 8 bit and saturate at 255, which is plenty for the small thresholds the 
+        shingle table cares about and keeps the sketch at width * depth bytes.
+        '''
+        self._width = width
+        self._depth = depth
+        self._counters = array('B', [0]) * (width * depth)
+
+    def _indices(self, item):
+        # Double hashing: row r uses h1 + r * h2, which behaves like depth independent hashes.
+        h1 = hash(item)
+        h2 = (h1 >> 32) | 1
+        for row in xrange(self._depth):
+            yield row * self._width + (h1 + row * h2) % self._width
+
+    def add(self, item):
+
+        counters = self._counters
+        for index in self._indices(item):
+            if counters[index] < 255:
+                counters[index] += 1
+
+    def estimate(self, item):
+        return min(self._counters[index] for index in self._indices(item))
+
+    def __contains__(self, item):
+        return self.estimate(item) > 0
+
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+class MinHasher(object):
+
+    def __init__(self, num_perm = 128, seed = 1):
+        '''
+        MinHash signatures of shingle sets: num_perm universal hashes (a * x + b) mod 2**61 - 1 
+        over hash(shingle), each keeping its minimum. Two signatures agree at any one index with 
+        probability equal to the Jaccard similarity of the two shingle sets. Works with any 
+        hashable shingle key (strings, token id tuples, rolling hashes).
+
+        num_perm:   Signature length. The standard error of a Jaccard estimate is about 1 / sqrt(num_perm).
+        seed:       Signatures are only comparable between MinHashers with the same num_perm and seed.
+        '''
+        rnd = random.Random(seed)
+        self.num_perm = num_perm
+        self._permutations = [(rnd.randint(1, MERSENNE_PRIME - 1), rnd.randint(0, MERSENNE_PRIME - 1)) for _ in xrange(num_perm)]
+
+    def signature(self, shingles):
+
+        hashes = set(hash(shingle) for shingle in shingles)
+        if not hashes:
+            return (MERSENNE_PRIME,) * self.num_perm
+
+        return tuple(min((a * x + b) % MERSENNE_PRIME for x in hashes) for a, b in self._permutations)
+
+    def signatures(self, shingle_record_iter):
+        '''
+        Yields (doc_id, signature) for every document of a ShingleRecord stream in which each 
+        document's records are consecutive, as Shingler.shingle_docs emits them.
+        '''
+        for doc_id, shingle_records in groupby(shingle_record_iter, key = attrgetter('doc_id')):
+            yield doc_id, self.signature(shingle_record.shingle for shingle_record in shingle_records)
+
+
+def estimate_jaccard(signature, other_signature):
+    return sum(1 for h, other_h in izip(signature, other_signature) if h == other_h) / float(len(signature))
+
+
+class LSHIndex(object):
+
+    def __init__(self, num_perm = 128, bands = 32):
+        '''
+        Locality sensitive hashing over MinHash signatures. Each signature is cut into bands of 
+        num_perm / bands rows, and documents whose signatures agree on every row of at least one 
+        band become candidates of each other. A pair with Jaccard similarity s is a candidate with 
+        probability 1 - (1 - s ** rows) ** bands, an S curve whose threshold is about 
+        (1 / bands) ** (1 / rows): more bands find less similar pairs, at the cost of more false 
+        candidates. A query costs one dict lookup per band plus the candidates found.
+        '''
+        if bands < 1 or num_perm % bands:
+            raise ValueError('bands must divide num_perm, got {0} bands for {1} permutations.'.format(bands, num_perm))
+
+        self._rows = num_perm // bands
+        self._band_tables = [{} for _ in xrange(bands)]
+        self.signatures = {}        # doc_id -> signature
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.signatures
+
+    def _band_keys(self, signature):
+        rows = self._rows
+        return [signature[band * rows:(band + 1) * rows] for band in xrange(len(self._band_tables))]
+
+    def add(self, doc_id, signature):
+
+        if doc_id in self.signatures:
+            raise ValueError('Document {0!r} is already in the index.'.format(doc_id))
+
+        self.signatures[doc_id] = signature
+        for band_table, band_key in izip(self._band_tables, self._band_keys(signature)):
+            band_table.setdefault(band_key, []).append(doc_id)
+
+    def query(self, signature):
+        '''Returns the set of indexed doc ids sharing at least one band with signature.'''
+
+        candidates = set()
+        for band_table, band_key in izip(self._band_tables, self._band_keys(signature)):
+            candidates.update(band_table.get(band_key, ()))
+
+        return candidates
+
+    def candidates(self, doc_id):
+        '''Returns the candidate targets of an indexed document (never itself).'''
+
+        candidates = self.query(self.signatures[doc_id])
+        candidates.discard(doc_id)
+        return candidates
+
+    def candidate_pairs(self, min_jaccard = None):
+        '''
+        Yields every candidate pair once, as (doc_id, other_doc_id, estimated_jaccard), optionally 
+        keeping only pairs whose signatures estimate at least min_jaccard.
+        '''
+        seen = set()
+        for band_table in self._band_tables:
+            for doc_ids in band_table.itervalues():
+                for k, doc_id in enumerate(doc_ids):
+                    for other_doc_id in doc_ids[k + 1:]:
+                        pair = (doc_id, other_doc_id)
+                        if pair in seen:
+                            continue
+                        seen.add(pair)
+                        jaccard = estimate_jaccard(self.signatures[doc_id], self.signatures[other_doc_id])
+                        if min_jaccard is None or jaccard >= min_jaccard:
+                            yield doc_id, other_doc_id, jaccard
+
+
+def build_lsh_index(shingle_record_iter, num_perm = 128, bands = 32, seed = 1):
+    '''
+    MinHashes every document of a ShingleRecord stream (see MinHasher.signatures) into a new 
+    LSHIndex, e.g. from the same Shingler.shingle_docs stream a ShingleTable is built from.
+    '''
+    index = LSHIndex(num_perm = num_perm, bands = bands)
+    for doc_id, signature in MinHasher(num_perm = num_perm, seed = seed).signatures(shingle_record_iter):
+        index.add(doc_id, signature)
+
+    return index
@@ -0,0 +1,57 @@
+class SpanResolver(object):
+
+    def __init__(self, token_offsets, shingle_size, texts = None):
+        '''
+        Maps Sequences and SequenceGroups back to character spans of the original documents, in 
+        O(1) per span and without re-tokenizing: the shingle at position i covers tokens 
+        i .. i + shingle_size - 1, whose character offsets were recorded while shingling.
+
+        token_offsets:  doc_id -> flat array [start_0, end_0, start_1, end_1, ...] of the character 
+                        offsets of the kept tokens, e.g. shingler.token_offsets of a 
+                        Shingler(record_offsets = True). 
+        shingle_size:   The shingle size of that Shingler.
+        texts:          Source of the documents' text for the *_text methods: a table_store.MappedTexts, 
+                        whose text(doc_id, start, end) reads only the span, or any mapping 
+                        doc_id -> document.
+        '''
+        self._token_offsets = token_offsets
+        self._shingle_size = shingle_size
+        self._texts = texts
+
+    def char_span(self, doc_id, position, length):
+        '''The character span [start, end) of length consecutive shingles from shingle position.'''
+
+        offsets = self._token_offsets[doc_id]
+        last_token = position + length + self._shingle_size - 2
+        return offsets[2 * position], offsets[2 * last_token + 1]
+
+    def source_span(self, sequence):
+        return self.char_span(sequence.src_doc_id, sequence.src_position, sequence.length)
+
+    def target_span(self, sequence):
+        return self.char_span(sequence.target_doc_id, sequence.target_position, sequence.target_length)
+
+    def group_span(self, group):
+
+        start_position, end_position = group.span
+        return self.char_span(self._group_doc_id(group), start_position, end_position - start_position)
+
+    def _group_doc_id(self, group):
+        return next(iter(group.sequences)).src_doc_id
+
+    def text(self, doc_id, char_span):
+
+        start, end = char_span
+        if hasattr(self._texts, 'text'):
+            return self._texts.text(doc_id, start, end)
+
+        return self._texts[doc_id][start:end]
+
+    def source_text(self, sequence):
+        return self.text(sequence.src_doc_id, self.source_span(sequence))
+
+    def target_text(self, sequence):
+        return self.text(sequence.target_doc_id, self.target_span(sequence))
+
+    def group_text(self, group):
+        return self.text(self._group_doc_id(group), self.group_span(group))
@@ -0,0 +1,85 @@
+from timeit import default_timer
+
+# Optional instrumentation shared by Shingler, ShingleTable and CommonSequenceGenerator. Components
+# take stats = None by default and then only pay an `is None` test per document or source position;
+# counts within those are accumulated locally and reported once.
+
+
+class Stats(object):
+
+    def __init__(self, on_stage = None):
+        '''
+        Collects counters, maxima, power of two histograms and per-stage wall time. One instance 
+        may be passed to several components; names are unique across them.
+
+        on_stage:   Optional callback on_stage(stage, seconds) called whenever a timed stage ends, 
+                    e.g. to log slow documents as they happen.
+        '''
+        self.counters = {}
+        self.maxima = {}
+        self.histograms = {}        # name -> {bucket upper bound (power of two): count}
+        self.timings = {}           # stage -> total seconds
+        self._on_stage = on_stage
+
+    def increment(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def maximum(self, name, value):
+        if value > self.maxima.get(name, value - 1):
+            self.maxima[name] = value
+
+    def observe(self, name, value):
+
+        histogram = self.histograms.setdefault(name, {})
+        bucket = 1 << (value - 1).bit_length() if value > 0 else 0
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def add_time(self, stage, seconds):
+
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        if self._on_stage is not None:
+            self._on_stage(stage, seconds)
+
+    def as_dict(self):
+        return dict(counters = dict(self.counters), maxima = dict(self.maxima), 
+                    histograms = dict( (name, dict(histogram)) for name, histogram in self.histograms.iteritems() ),
+                    timings = dict(self.timings))
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(self.__class__.__name__, self.as_dict())
+
+
+class _StageTimer(object):
+
+    __slots__ = ('_stats', '_stage', '_start')
+
+    def __init__(self, stats, stage):
+        self._stats = stats
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = default_timer()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stats.add_time(self._stage, default_timer() - self._start)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+NULL_TIMER = _NullTimer()
+
+def timed(stats, stage):
+    '''
+    Context manager adding the wall time of its block to stats.timings[stage], or a shared no-op 
+    when stats is None.
+    '''
+    if stats is None:
+        return NULL_TIMER
+
+    return _StageTimer(stats, stage)
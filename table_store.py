@@ -0,0 +1,250 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+# On-disk layout of a saved table: a directory holding a json header plus one flat, native
+# endian file per array. Arrays are written with array.tofile and read back through mmap, so
+# opening a table costs a few system calls and every process mapping it shares the page cache.
+
+FORMAT_VERSION = 1
+HEADER_FILE_NAME = 'header.json'
+STRINGS_TYPECODE = 'l'
+WRITE_BUFFER_SIZE = 1 << 16
+
+
+def _file_path(path, name):
+    return os.path.join(path, name + '.bin')
+
+def write_header(path, header):
+
+    header = dict(header,
+                  format_version = FORMAT_VERSION,
+                  byteorder = sys.byteorder,
+                  itemsizes = dict((typecode, array(typecode).itemsize) for typecode in 'il'))
+    with open(os.path.join(path, HEADER_FILE_NAME), 'w') as header_file:
+        json.dump(header, header_file)
+
+def read_header(path):
+
+    with open(os.path.join(path, HEADER_FILE_NAME)) as header_file:
+        header = json.load(header_file)
+
+    if header['format_version'] != FORMAT_VERSION:
+        raise ValueError('Unsupported table format version {0}.'.format(header['format_version']))
+
+    itemsizes = dict((typecode, array(typecode).itemsize) for typecode in 'il')
+    if header['byteorder'] != sys.byteorder or header['itemsizes'] != itemsizes:
+        raise ValueError('Table at {0} was written on a platform with a different byte order or int sizes.'.format(path))
+
+    return header
+
+def write_array(path, name, values):
+    '''Writes an in-memory array.array to the flat array file path/name.bin in one go.'''
+    with open(_file_path(path, name), 'wb') as array_file:
+        values.tofile(array_file)
+
+
+class ArrayWriter(object):
+
+    def __init__(self, path, name, typecode):
+        '''
+        Streams integers to the flat array file path/name.bin, buffering WRITE_BUFFER_SIZE items
+        at a time so arrays larger than memory can be written.
+        '''
+        self._file = open(_file_path(path, name), 'wb')
+        self._buffer = array(typecode)
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, value):
+
+        self._buffer.append(value)
+        self._length += 1
+        if len(self._buffer) >= WRITE_BUFFER_SIZE:
+            self._flush()
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def _flush(self):
+        self._buffer.tofile(self._file)
+        del self._buffer[:]
+
+    def close(self):
+        self._flush()
+        self._file.close()
+
+
+class StringsWriter(object):
+
+    def __init__(self, path, name):
+        '''
+        Streams unicode strings to path/name.bin as concatenated utf-8, with the byte offsets of
+        every string in path/name_offsets.bin.
+        '''
+        self._file = open(_file_path(path, name), 'wb')
+        self._offsets = ArrayWriter(path, name + '_offsets', STRINGS_TYPECODE)
+        self._offsets.append(0)
+        self._end = 0
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def append(self, s):
+
+        encoded = s.encode('utf-8')
+        self._file.write(encoded)
+        self._end += len(encoded)
+        self._offsets.append(self._end)
+
+    def close(self):
+        self._offsets.close()
+        self._file.close()
+
+
+class MappedArray(object):
+
+    def __init__(self, path, name, typecode):
+        '''
+        Read only, memory mapped view of a flat array file. Indexing returns an int; slicing
+        (step 1 only) copies just the requested range into an array.array.
+        '''
+        self._typecode = typecode
+        self._itemsize = array(typecode).itemsize
+        with open(_file_path(path, name), 'rb') as array_file:
+            size = os.fstat(array_file.fileno()).st_size
+            # mmap refuses empty files; an empty string slices the same way.
+            self._buffer = mmap.mmap(array_file.fileno(), 0, access = mmap.ACCESS_READ) if size else ''
+        self._length = size // self._itemsize
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, k):
+
+        if isinstance(k, slice):
+            start, stop, _ = k.indices(self._length)
+            return array(self._typecode, self._buffer[start * self._itemsize:max(start, stop) * self._itemsize])
+
+        if k < 0:
+            k += self._length
+        if not 0 <= k < self._length:
+            raise IndexError('MappedArray index out of range')
+
+        return struct.unpack_from(self._typecode, self._buffer, k * self._itemsize)[0]
+
+    def __iter__(self):
+        for k in xrange(self._length):
+            yield self[k]
+
+    def close(self):
+        if self._buffer:
+            self._buffer.close()
+
+
+class MappedStrings(object):
+
+    def __init__(self, path, name):
+        '''
+        Read only, memory mapped sequence of the unicode strings written by a StringsWriter.
+        Strings are decoded on access, so a sorted MappedStrings can be searched with bisect.
+        '''
+        self._offsets = MappedArray(path, name + '_offsets', STRINGS_TYPECODE)
+        self._data = MappedArray(path, name, 'c')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, k):
+
+        if not 0 <= k < len(self):
+            raise IndexError('MappedStrings index out of range')
+
+        start, end = self._offsets[k], self._offsets[k + 1]
+        return self._data[start:end].tostring().decode('utf-8')
+
+    def __iter__(self):
+        for k in xrange(len(self)):
+            yield self[k]
+
+    def close(self):
+        self._offsets.close()
+        self._data.close()
+
+
+# Document texts, stored in a fixed width encoding of one code unit per unicode index (utf-32 on
+# wide builds, utf-16 on narrow ones, whose unicode strings index utf-16 code units), so that a
+# character span of a document is a byte range of the mapped file and reads in O(span).
+
+TEXT_ENCODING, TEXT_CODE_UNIT_SIZE = ('utf-32-le', 4) if sys.maxunicode > 0xffff else ('utf-16-le', 2)
+TEXTS_HEADER_FILE_NAME = 'texts.json'
+
+def write_texts(path, doc_record_iter):
+    '''
+    Writes the documents of doc_record_iter to path/texts.bin (see MappedTexts). Documents should 
+    be unicode; byte strings are decoded as ascii.
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    doc_ids = []
+    offsets = ArrayWriter(path, 'text_offsets', STRINGS_TYPECODE)
+    offsets.append(0)
+    end = 0
+    with open(_file_path(path, 'texts'), 'wb') as texts_file:
+        for doc_record in doc_record_iter:
+            doc = unicode(doc_record.doc)
+            texts_file.write(doc.encode(TEXT_ENCODING))
+            end += len(doc)
+            offsets.append(end)
+            doc_ids.append(doc_record.doc_id)
+    offsets.close()
+
+    with open(os.path.join(path, TEXTS_HEADER_FILE_NAME), 'w') as header_file:
+        json.dump(dict(format_version = FORMAT_VERSION, encoding = TEXT_ENCODING, doc_ids = doc_ids), header_file)
+
+
+class MappedTexts(object):
+
+    def __init__(self, path):
+        '''
+        Read only, memory mapped document texts written by write_texts. texts[doc_id] decodes a 
+        whole document; texts.text(doc_id, start, end) only the requested character span.
+        '''
+        with open(os.path.join(path, TEXTS_HEADER_FILE_NAME)) as header_file:
+            header = json.load(header_file)
+
+        if header['format_version'] != FORMAT_VERSION or header['encoding'] != TEXT_ENCODING:
+            raise ValueError('Texts at {0} were written with an unsupported format or encoding.'.format(path))
+
+        self._doc_indices = dict( (doc_id, doc_index) for doc_index, doc_id in enumerate(header['doc_ids']) )
+        self._offsets = MappedArray(path, 'text_offsets', STRINGS_TYPECODE)
+        self._data = MappedArray(path, 'texts', 'c')
+
+    def __len__(self):
+        return len(self._doc_indices)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._doc_indices
+
+    def __getitem__(self, doc_id):
+        return self.text(doc_id)
+
+    def text(self, doc_id, start = 0, end = None):
+
+        doc_index = self._doc_indices[doc_id]
+        doc_start, doc_end = self._offsets[doc_index], self._offsets[doc_index + 1]
+        end = doc_end - doc_start if end is None else min(end, doc_end - doc_start)
+        start = min(start, end)
+        byte_range = self._data[(doc_start + start) * TEXT_CODE_UNIT_SIZE:(doc_start + end) * TEXT_CODE_UNIT_SIZE]
+        return byte_range.tostring().decode(TEXT_ENCODING)
+
+    def close(self):
+        self._offsets.close()
+        self._data.close()
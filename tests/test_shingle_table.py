@@ -1,16 +1,30 @@
 import sys
 sys.path.append('..')
 
-from shingle_table import ShingleTable
-from csg import Sequence, CommonSequenceGenerator, SequenceGroup
-from shingler import Shingler
-from normalizers import BasicNormalizer
+from shingle_table import ShingleTable, CompactShingleTable, TwoPassShingleTable, MappedShingleTable
+from csg import Sequence, CommonSequenceGenerator, SequenceGroup, SequenceGroupIndex, sequence_order
+from csg import SELF_MATCH_EXCLUDE, SELF_MATCH_NON_OVERLAPPING, SELF_MATCH_ALLOW
+from shingler import Shingler, SHINGLE_KEY_TOKEN_IDS, SHINGLE_KEY_HASH, HASH_BASE, HASH_MASK
+from normalizers import BasicNormalizer, FusedBasicNormalizer
 from dto import DocRecord, ShingleRecord
+from parallel import build_shingle_table_parallel, generate_common_sequences_parallel
+from external_sort import build_table_on_disk, ExternalSorter
+from stats import Stats
+from spans import SpanResolver
+from table_store import write_texts, MappedTexts
+from sketches import MinHasher, LSHIndex, build_lsh_index, estimate_jaccard
+from service import QueryService, QueryServer, QueryClient, LatencyTracker, sequence_group_as_dict, _run_query
 
 from utils.debug_utils import test_suite_from_test_cases
 
 from abc import ABCMeta, abstractproperty
 from itertools import product
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
 
 import unittest
 
@@ -86,6 +100,14 @@ class SequenceTest(unittest.TestCase):
 		self.assertTrue( all(seq in seq_set for seq in self._test_sequences) )
 
 
+	def test_pickling(self):
+
+		self.increment_sequence(self._test_sequence, self._test_sequence_increment_amount)
+		for protocol in xrange(pickle.HIGHEST_PROTOCOL + 1):
+			seq = pickle.loads(pickle.dumps(self._test_sequence, protocol))
+			self.assertEqual(seq, self._test_sequence)
+			self.assertEqual(seq.length, self._test_sequence.length)
+
 	def test_raise_on_attr_set(self):
 		seq = self._create_test_sequence()
 		non_settable_attr_names = [u'src_doc_id',u'src_position',u'target_doc_id',u'target_position',u'length']
@@ -238,42 +260,122 @@ class SeriesOfSingletonsGroupsTest(AbstractSequenceGroupTest):
 	def _expected_lengths(self):
 		return [3,1,100]
 
+class UnorderedGroupTest(AbstractSequenceGroupTest):
+
+	@property
+	def _sequence_infos(self):
+		return [(6,3), (0,2), (9,1), (1,6)]
+
+	@property 
+	def _expected_spans(self):
+		return [(0,9), (9,10)]
+
+	@property 
+	def _expected_lengths(self):
+		return [9,1]
+
+	def test_input_unchanged(self):
+		self.assertEqual([(seq.src_position, seq.length) for seq in self.test_sequences], self._sequence_infos)
+
+class ChainedOverlapGroupTest(AbstractSequenceGroupTest):
+
+	# (6,2) only overlaps (4,3), which the group absorbed through its first sequence
+
+	@property
+	def _sequence_infos(self):
+		return [(0,5), (1,1), (4,3), (6,2), (8,1)]
+
+	@property 
+	def _expected_spans(self):
+		return [(0,8), (8,9)]
+
+	@property 
+	def _expected_lengths(self):
+		return [8,1]
+
+class SequenceGroupIndexTest(unittest.TestCase):
+
+	def setUp(self):
+		sequences = []
+		for src_position, length in [(0,3), (2,2), (6,1), (10,5), (12,1)]:
+			sequence = Sequence(0, src_position, 1, 0)
+			SequenceTest.increment_sequence(sequence, length - 1)
+			sequences.append(sequence)
+		self.groups = SequenceGroup.group_sequences(sequences)
+		self.index = SequenceGroupIndex(reversed(self.groups))
+
+	def test_covering(self):
+		self.assertEqual(len(self.index), 3)
+		covering_spans = [ [group.span for group in self.index.covering(p)] for p in xrange(16) ]
+		self.assertEqual(covering_spans, [[(0,4)]] * 4 + [[], [], [(6,7)], [], [], []] + [[(10,15)]] * 5 + [[]])
+
+	def test_overlapping(self):
+		self.assertEqual([group.span for group in self.index.overlapping(3, 11)], [(0,4), (6,7), (10,15)])
+		self.assertEqual([group.span for group in self.index.overlapping(4, 6)], [])
+
+	def test_overlapping_groups(self):
+		# groups from different documents may overlap each other
+		index = SequenceGroupIndex(self.groups + SequenceGroup.group_sequences([Sequence(0, 3, 2, 0)]))
+		self.assertEqual([group.span for group in index.covering(3)], [(0,4), (3,4)])
+
 # class ShinglerTest(unittest.TestCase):
 # 	pass 
 	
 # class ShingleTableTest(unittest.TestCase):
 # 	pass 
-	
-class CommonSequenceGeneratorTest(unittest.TestCase):
-	
-	shingle_size = 8
-	doc_ids = [0,1,2]
 
-	doc_0_content = '''
+# the three document corpus most tests run on: docs 1 and 2 share one sequence of length 3
+
+SHINGLE_SIZE = 8
+DOC_IDS = [0,1,2]
+
+DOC_0_CONTENT = '''
 	My name is test. Blah Blah Blah. I will not match anything.
 	'''
 
-	doc_1_content = '''
+DOC_1_CONTENT = '''
 	This document should nearly match another document that I will write below.
 	'''
 
-	doc_2_content = '''
+DOC_2_CONTENT = '''
 	I would say his doc should nearly match another document that I will write below. How's that?
 	'''
 
+def get_shingler():
+	norm_fn = BasicNormalizer().normalize
+	return Shingler(shingle_size = SHINGLE_SIZE, normalization_fn = norm_fn, token_ptrn = r"(?u)\b\w+\b")
+
+def get_doc_records():
+	doc_texts = [DOC_0_CONTENT, DOC_1_CONTENT, DOC_2_CONTENT]
+	return map(DocRecord, DOC_IDS, doc_texts)
+
+def get_shingles(shingler = None):
+	shingler = shingler if shingler is not None else get_shingler()
+	return shingler.shingle_docs(get_doc_records())
+	
+class CommonSequenceGeneratorTest(unittest.TestCase):
+	
+	shingle_size = SHINGLE_SIZE
+	doc_ids = DOC_IDS
+
+	doc_0_content = DOC_0_CONTENT
+	doc_1_content = DOC_1_CONTENT
+	doc_2_content = DOC_2_CONTENT
+
 	def setUp(self):
 		self._build_shingle_table()
 
 	def _build_shingle_table(self):
-		norm_fn = BasicNormalizer().normalize
-		shingler = Shingler(shingle_size = self.shingle_size, normalization_fn = norm_fn, token_ptrn = r"(?u)\b\w+\b")
-		doc_records = self._get_doc_records()
-		shingles = shingler.shingle_docs(doc_records)
-		self._shingle_table = ShingleTable(shingles)
+		self._shingle_table = ShingleTable(self._get_shingles())
+
+	def _get_shingler(self):
+		return get_shingler()
+
+	def _get_shingles(self):
+		return get_shingles(self._get_shingler())
 
 	def _get_doc_records(self):
-		doc_texts = [self.doc_0_content, self.doc_1_content, self.doc_2_content]
-		return map(DocRecord, self.doc_ids, doc_texts)
+		return get_doc_records()
 
 	def test_generate_common_sequences(self):
 		
@@ -300,11 +402,885 @@ class CommonSequenceGeneratorTest(unittest.TestCase):
 										  length = 3
 										  )
 
+	def test_generate_all_common_sequences(self):
+
+		# the doc 1 / doc 2 match is reported once, from the lower doc id
+
+		csg = CommonSequenceGenerator(self._shingle_table)
+		sequences = list(csg.generate_all_common_sequences())
+		self.assertEqual(len(sequences), 1)
+		expected = Sequence(src_doc_id = 1, src_position = 2, target_doc_id = 2, target_position = 5)
+		expected.increment_length()
+		expected.increment_length()
+		self.assertEqual(sequences, [expected])
+
 	def _assertExpectedSequenceGroup(self, sequence_group, span, length):
 		self.assertEqual(sequence_group.span, span)
 		self.assertEqual(sequence_group.length, length)
 
 
+class CompactShingleTableTest(CommonSequenceGeneratorTest):
+
+	def setUp(self):
+		self._build_shingle_table()
+		self._compact_shingle_table = CompactShingleTable(self._get_shingles())
+
+	def test_buckets_match(self):
+		compact = self._compact_shingle_table
+		self.assertEqual(len(compact), len(self._shingle_table))
+		for shingle_id, bucket in compact.iteritems():
+			shingle = compact.shingle(shingle_id)
+			self.assertEqual(compact.shingle_id(shingle), shingle_id)
+			self.assertEqual(bucket.copy(), self._shingle_table[shingle])
+			self.assertTrue(all(posting in bucket for posting in self._shingle_table[shingle]))
+			self.assertFalse((0, 0) in bucket)
+
+	def test_invert_matches(self):
+		compact = self._compact_shingle_table
+		compact_inverted = compact.invert()
+		inverted = self._shingle_table.invert()
+		self.assertEqual(sorted(compact_inverted.keys()), sorted(inverted.keys()))
+		for doc_id, inv_bucket in inverted.iteritems():
+			compact_inv_bucket = [(compact.shingle(shingle_id), i) for shingle_id, i in compact_inverted[doc_id]]
+			self.assertEqual(compact_inv_bucket, inv_bucket)
+
+	def test_generate_common_sequences(self):
+		self._shingle_table = self._compact_shingle_table
+		super(CompactShingleTableTest, self).test_generate_common_sequences()
+
+
+class TwoPassShingleTableTest(CommonSequenceGeneratorTest):
+
+	def _build_shingle_table(self):
+		self._single_pass_shingle_table = ShingleTable(self._get_shingles())
+		self._shingle_table = TwoPassShingleTable(self._get_shingles)
+
+	def test_matches_single_pass_build(self):
+		self.assertEqual(self._shingle_table, self._single_pass_shingle_table)
+
+	def test_matches_single_pass_build_under_collisions(self):
+		two_pass_table = TwoPassShingleTable(self._get_shingles, sketch_width = 4, sketch_depth = 2)
+		self.assertEqual(two_pass_table, self._single_pass_shingle_table)
+
+	def test_build_stats(self):
+		# singletons held back by the sketch are counted as purged, as in a single pass build
+		for two_pass_table in (self._shingle_table, TwoPassShingleTable(self._get_shingles, sketch_width = 4, sketch_depth = 2)):
+			self.assertEqual(two_pass_table.build_stats, self._single_pass_shingle_table.build_stats)
+
+		stats, single_pass_stats = Stats(), Stats()
+		TwoPassShingleTable(self._get_shingles, stats = stats)
+		ShingleTable(self._get_shingles(), stats = single_pass_stats)
+		self.assertEqual(stats.counters['singletons_purged'], single_pass_stats.counters['singletons_purged'])
+		self.assertTrue(stats.counters['singletons_purged'] > 0)
+
+
+class ParallelShingleTableTest(CommonSequenceGeneratorTest):
+
+	def _build_shingle_table(self):
+		self._shingle_table = build_shingle_table_parallel(self._get_doc_records(), self._get_shingler(), processes = 2, shard_size = 1)
+
+	def test_matches_serial_build(self):
+		self.assertEqual(self._shingle_table, ShingleTable(self._get_shingles()))
+
+	def test_generate_common_sequences_parallel(self):
+		csg = CommonSequenceGenerator(self._shingle_table)
+		for ordered in (True, False):
+			results = generate_common_sequences_parallel(csg, self.doc_ids, processes = 2, chunk_size = 1, ordered = ordered)
+			spans = dict( (doc_id, [group.span for group in groups]) for doc_id, groups in results )
+			self.assertEqual(spans, {0: [], 1: [(2,5)], 2: [(5,8)]})
+
+
+class MappedShingleTableTest(CommonSequenceGeneratorTest):
+
+	def _build_shingle_table(self):
+		self._table_dir = tempfile.mkdtemp()
+		self._in_memory_shingle_table = ShingleTable(self._get_shingles())
+		self._in_memory_shingle_table.save(self._table_dir)
+		self._shingle_table = MappedShingleTable(self._table_dir)
+
+	def tearDown(self):
+		self._shingle_table.close()
+		shutil.rmtree(self._table_dir)
+
+	def test_buckets_match(self):
+		mapped = self._shingle_table
+		self.assertEqual(len(mapped), len(self._in_memory_shingle_table))
+		for shingle, bucket in self._in_memory_shingle_table.iteritems():
+			self.assertEqual(mapped[mapped.shingle_id(shingle)].copy(), bucket)
+
+	def test_invert_matches(self):
+		mapped = self._shingle_table
+		mapped_inverted = mapped.invert()
+		inverted = self._in_memory_shingle_table.invert()
+		self.assertEqual(sorted(mapped_inverted.keys()), sorted(inverted.keys()))
+		for doc_id, inv_bucket in inverted.iteritems():
+			mapped_inv_bucket = [(mapped.shingle(shingle_id), i) for shingle_id, i in mapped_inverted[doc_id]]
+			self.assertEqual(mapped_inv_bucket, inv_bucket)
+
+	def test_shingler_restored(self):
+		shingler = self._get_shingler()
+		table_dir = tempfile.mkdtemp()
+		try:
+			ShingleTable(shingler.shingle_docs(self._get_doc_records()), shingler = shingler).save(table_dir)
+			mapped = MappedShingleTable(table_dir)
+			self.assertEqual(mapped.shingler.config(), shingler.config())
+			query = DocRecord(u'query', u'he said: ' + self.doc_1_content)
+			self.assertEqual([group.span for group in CommonSequenceGenerator(mapped).find_common_sequences(query)], [(4,7)])
+
+			other_shingler = Shingler(shingle_size = self.shingle_size, normalization_fn = FusedBasicNormalizer().normalize)
+			self.assertRaises(ValueError, MappedShingleTable, table_dir, shingler = other_shingler)
+			mapped.close()
+		finally:
+			shutil.rmtree(table_dir)
+
+		self.assertEqual(Shingler(2, lambda token: token).config(), None)
+		self.assertEqual(self._shingle_table.shingler, None)
+
+
+class SelfMatchPolicyTest(unittest.TestCase):
+
+	# 'a b' and 'b c' each occur twice in doc 0 (positions 0, 1 and 4, 5)
+	repeated_doc_content = u'a b c x a b c y'
+	# every shingle of doc 1 is shared with every other one
+	periodic_doc_content = u'a a a a a a'
+	# doc 2 repeats every 4 tokens
+	quoted_doc_content = u'to be or not to be or not to be'
+
+	def setUp(self):
+		shingler = Shingler(shingle_size = 2, normalization_fn = BasicNormalizer().normalize, token_ptrn = r"(?u)\b\w+\b")
+		doc_records = [DocRecord(0, self.repeated_doc_content), DocRecord(1, self.periodic_doc_content), DocRecord(2, self.quoted_doc_content)]
+		self._shingle_table = ShingleTable(shingler.shingle_docs(doc_records), shingler = shingler)
+
+	def _sequence_keys(self, doc_id, policy):
+		csg = CommonSequenceGenerator(self._shingle_table, self_match_policy = policy)
+		groups = csg.generate_common_sequences(doc_id)
+		return sorted( (seq.src_position, seq.target_position, seq.length) for group in groups for seq in group._sequences )
+
+	def test_exclude(self):
+		self.assertEqual(self._sequence_keys(0, SELF_MATCH_EXCLUDE), [])
+
+	def test_non_overlapping(self):
+		self.assertEqual(self._sequence_keys(0, SELF_MATCH_NON_OVERLAPPING), [(0,4,2), (4,0,2)])
+		# a run of n shingles covers n + 1 tokens
+		for doc_id in (1, 2):
+			for src_position, target_position, length in self._sequence_keys(doc_id, SELF_MATCH_NON_OVERLAPPING):
+				self.assertTrue(0 < length + 1 <= abs(target_position - src_position))
+		self.assertEqual(self._sequence_keys(2, SELF_MATCH_NON_OVERLAPPING)[0], (0,4,3))
+
+		with self.assertRaises(ValueError):
+			CommonSequenceGenerator(ShingleTable(self._shingle_table._records()), self_match_policy = SELF_MATCH_NON_OVERLAPPING)
+
+	def test_allow(self):
+		self.assertEqual(self._sequence_keys(0, SELF_MATCH_ALLOW), [(0,0,2), (0,4,2), (4,0,2), (4,4,2)])
+
+	def test_all_common_sequences(self):
+		csg = CommonSequenceGenerator(self._shingle_table, self_match_policy = SELF_MATCH_NON_OVERLAPPING)
+		sequences = [seq for seq in csg.generate_all_common_sequences() if seq.src_doc_id == 0]
+		self.assertEqual([(seq.src_position, seq.target_position, seq.length) for seq in sequences], [(0,4,2)])
+
+	def test_unknown_policy(self):
+		with self.assertRaises(ValueError):
+			CommonSequenceGenerator(self._shingle_table, self_match_policy = 'sometimes')
+
+
+class StopShingleTest(unittest.TestCase):
+
+	boilerplate = u'this message is confidential'
+	quote = u'to be or not to be'
+	doc_contents = [
+					u'alpha beta gamma ' + quote + u' delta ' + boilerplate,
+					u'epsilon ' + quote + u' zeta eta ' + boilerplate,
+					u'theta iota kappa ' + boilerplate,
+					u'lambda mu ' + boilerplate,
+				   ]
+
+	def setUp(self):
+		self._shingler = Shingler(shingle_size = 3, normalization_fn = BasicNormalizer().normalize, token_ptrn = r"(?u)\b\w+\b")
+
+	def _get_shingles(self):
+		return self._shingler.shingle_docs(map(DocRecord, range(len(self.doc_contents)), self.doc_contents))
+
+	def _boilerplate_shingles(self):
+		return set([u'this message is', u'message is confidential'])
+
+	def test_absolute_max_df(self):
+		table = ShingleTable(self._get_shingles(), max_df = 2, keep_stop_shingles = True)
+		self.assertEqual(set(table.stop_shingles), self._boilerplate_shingles())
+		self.assertTrue(all(df == 4 for df in table.stop_shingles.values()))
+		self.assertFalse(self._boilerplate_shingles() & set(table))
+		self.assertTrue(u'be or not' in table)
+		self.assertEqual(table.build_stats[u'max_df_cutoff'], 2)
+		self.assertEqual(table.build_stats[u'n_stop_shingles'], 2)
+		self.assertEqual(table.build_stats[u'n_docs'], 4)
+
+	def test_fractional_max_df(self):
+		table = ShingleTable(self._get_shingles(), max_df = 0.5)
+		self.assertEqual(table.build_stats[u'max_df_cutoff'], 2)
+		self.assertEqual(table.stop_shingles, {})
+		self.assertFalse(self._boilerplate_shingles() & set(table))
+
+	def test_default_keeps_everything(self):
+		table = ShingleTable(self._get_shingles())
+		self.assertTrue(self._boilerplate_shingles() <= set(table))
+		self.assertEqual(table.build_stats[u'max_df_cutoff'], None)
+
+	def test_parallel_build_matches(self):
+		table = ShingleTable(self._get_shingles(), max_df = 0.5, keep_stop_shingles = True)
+		doc_records = map(DocRecord, range(len(self.doc_contents)), self.doc_contents)
+		parallel_table = build_shingle_table_parallel(doc_records, self._shingler, processes = 2, shard_size = 1, max_df = 0.5, keep_stop_shingles = True)
+		self.assertEqual(parallel_table, table)
+		self.assertEqual(parallel_table.stop_shingles, table.stop_shingles)
+		self.assertEqual(parallel_table.build_stats, table.build_stats)
+
+	def test_invalid_max_df(self):
+		for max_df in (0, 1.5, -0.1, True, '2'):
+			with self.assertRaises(ValueError):
+				ShingleTable(self._get_shingles(), max_df = max_df)
+
+	def test_long_max_df(self):
+		self.assertEqual(ShingleTable(self._get_shingles(), max_df = 2L), ShingleTable(self._get_shingles(), max_df = 2))
+
+
+class IncrementalShingleTableTest(CommonSequenceGeneratorTest):
+
+	def _build_shingle_table(self):
+		# docs 1 and 2 share the only common sequence, so every shingle is unique before doc 2 arrives
+		self._shingle_table = ShingleTable(self._get_shingles(doc_ids = [0, 1]), retain_uniques = True)
+		self._csg_before_add = CommonSequenceGenerator(self._shingle_table)
+		self._shingle_table.add_documents(self._get_shingles(doc_ids = [2]))
+
+	def _get_shingles(self, doc_ids = None):
+		shingles = super(IncrementalShingleTableTest, self)._get_shingles()
+		if doc_ids is None:
+			return shingles
+		return (shingle for shingle in shingles if shingle.doc_id in doc_ids)
+
+	def test_add_matches_full_build(self):
+		full_table = ShingleTable(self._get_shingles())
+		self.assertEqual(self._shingle_table, full_table)
+		self.assertEqual(self._shingle_table.invert(), full_table.invert())
+		self.assertEqual(self._shingle_table.n_docs, 3)
+
+	def test_existing_generator_sees_added_documents(self):
+		groups_2 = self._csg_before_add.generate_common_sequences(2)
+		self.assertEqual([group.span for group in groups_2], [(5,8)])
+
+	def test_remove_matches_full_build(self):
+		self._shingle_table.remove_documents([2])
+		self.assertEqual(self._shingle_table, ShingleTable(self._get_shingles(doc_ids = [0, 1])))
+		self.assertEqual(self._shingle_table.invert(), {})
+
+		self._shingle_table.remove_documents([1])
+		self._shingle_table.add_documents(self._get_shingles(doc_ids = [1]))
+		full_table = ShingleTable(self._get_shingles(doc_ids = [0, 1, 2]))
+		self._shingle_table.add_documents(self._get_shingles(doc_ids = [2]))
+		self.assertEqual(self._shingle_table, full_table)
+		self.assertEqual(self._shingle_table.invert(), full_table.invert())
+
+	def test_add_existing_document(self):
+		with self.assertRaises(ValueError):
+			self._shingle_table.add_documents(self._get_shingles(doc_ids = [1]))
+
+	def test_requires_retain_uniques(self):
+		with self.assertRaises(ValueError):
+			ShingleTable(self._get_shingles()).add_documents(self._get_shingles(doc_ids = [2]))
+
+
+class ExternalQueryTest(unittest.TestCase):
+
+	def setUp(self):
+		# doc 2 is not in the corpus; its match with doc 1 is only found through retained singletons
+		shingles = (shingle for shingle in get_shingles() if shingle.doc_id != 2)
+		self._shingle_table = ShingleTable(shingles, retain_uniques = True, shingler = get_shingler())
+
+	def _query_spans(self, shingle_table, doc_record):
+		groups = CommonSequenceGenerator(shingle_table).find_common_sequences(doc_record)
+		return [(group.span, group.length) for group in groups]
+
+	def test_find_common_sequences(self):
+		query = DocRecord(u'query', DOC_2_CONTENT)
+		self.assertEqual(self._query_spans(self._shingle_table, query), [((5,8), 3)])
+		self.assertEqual(self._shingle_table, {})
+
+	def test_find_common_sequences_compact(self):
+		compact_table = CompactShingleTable(get_shingles(), shingler = get_shingler())
+		query = DocRecord(u'query', u'he said: ' + DOC_1_CONTENT)
+		self.assertEqual(self._query_spans(compact_table, query), [((4,7), 3)])
+
+	def test_no_match(self):
+		self.assertEqual(self._query_spans(self._shingle_table, DocRecord(u'query', u'nothing to see here')), [])
+
+	def test_token_ids_not_assigned(self):
+		# queries must not grow the vocabulary of a token id shingler
+		shingler = Shingler(shingle_size = SHINGLE_SIZE, normalization_fn = FusedBasicNormalizer().normalize,
+		                    token_ptrn = r"(?u)\b\w+\b", shingle_key = SHINGLE_KEY_TOKEN_IDS)
+		table = ShingleTable(get_shingles(shingler), retain_uniques = True, shingler = shingler)
+		token_ids = dict(shingler._token_ids)
+		query = DocRecord(u'query', u'brand new words: ' + DOC_1_CONTENT)
+		self.assertEqual(self._query_spans(table, query), [((3,8), 5)])
+		self.assertEqual(self._query_spans(table, DocRecord(u'query', u'unseen words only, not one of them known')), [])
+		self.assertEqual(shingler._token_ids, token_ids)
+
+	def test_requires_shingler(self):
+		with self.assertRaises(ValueError):
+			table = ShingleTable(get_shingles())
+			CommonSequenceGenerator(table).find_common_sequences(DocRecord(u'query', DOC_2_CONTENT))
+
+
+class ExternalSortTableTest(MappedShingleTableTest):
+
+	def _build_shingle_table(self):
+		# a budget of a few records forces several spilled runs
+		self._table_dir = tempfile.mkdtemp()
+		self._in_memory_shingle_table = ShingleTable(self._get_shingles())
+		self._shingle_table = build_table_on_disk(self._get_shingles(), self._table_dir, memory_budget = 2000)
+
+	def test_bounded_fan_in(self):
+		run_dir = tempfile.mkdtemp()
+		try:
+			records = [(u'shingle {0}'.format(k % 37), k % 5, k) for k in xrange(1000)]
+			sorter = ExternalSorter(2000, run_dir, record_size = lambda record: 100, max_fan_in = 3)
+			for record in records:
+				sorter.add(record)
+			self.assertTrue(len(sorter._run_paths) > 9)
+			self.assertEqual(list(sorter.sorted_records()), sorted(records))
+			self.assertTrue(len(sorter._run_paths) <= 3)
+			self.assertEqual(len(os.listdir(run_dir)), len(sorter._run_paths))
+		finally:
+			shutil.rmtree(run_dir)
+
+class ShinglerFastPathTest(CommonSequenceGeneratorTest):
+	# token id shingles from the fused normalizer must give the same sequences as joined strings
+
+	def _get_shingler(self):
+		return Shingler(shingle_size = self.shingle_size, normalization_fn = FusedBasicNormalizer().normalize,
+		                token_ptrn = r"(?u)\b\w+\b", shingle_key = SHINGLE_KEY_TOKEN_IDS)
+
+	def test_fused_normalizer(self):
+		tokens = [u'Blah', u'3rd', u'2014', u'How\'s', u'caf\xe9', u' Mixed\tCASE ', u'', u'x_y']
+		self.assertEqual(map(FusedBasicNormalizer().normalize, tokens), map(BasicNormalizer().normalize, tokens))
+
+	def test_string_shingles(self):
+		normalize = BasicNormalizer().normalize
+		doc = self.doc_2_content + u' 1 2 3 ' + self.doc_1_content
+		tokens = filter(None, map(normalize, Shingler(1, normalize, token_ptrn = r"(?u)\b\w+\b")._tokenize(doc)))
+		expected = [u' '.join(tokens[i:i+self.shingle_size]) for i in xrange(len(tokens) - self.shingle_size + 1)]
+
+		for cache_size in (0, 2, 100000):
+			shingler = Shingler(shingle_size = self.shingle_size, normalization_fn = normalize, token_ptrn = r"(?u)\b\w+\b",
+			                    normalization_cache_size = cache_size)
+			shingles = [record.shingle for record in shingler.shingle_doc(DocRecord(0, doc))]
+			self.assertEqual(shingles, expected)
+			self.assertEqual(map(type, shingles), map(type, expected))
+
+		short_doc = DocRecord(0, u'too short')
+		self.assertEqual(list(self._get_shingler().shingle_doc(short_doc)), [])
+
+	def test_normalization_cache(self):
+		# both tokenizing paths share one bounded cache
+		stats = Stats()
+		shingler = Shingler(shingle_size = 2, normalization_fn = BasicNormalizer().normalize, token_ptrn = r"(?u)\b\w+\b",
+		                    normalization_cache_size = 2, stats = stats)
+		doc = u'a B a B a'
+		self.assertEqual(shingler.normalized_tokens_with_offsets(doc)[0], [u'a', u'b', u'a', u'b', u'a'])
+		self.assertEqual(shingler.normalized_tokens(doc), [u'a', u'b', u'a', u'b', u'a'])
+		self.assertEqual(stats.counters['normalization_cache_misses'], 0)
+		self.assertEqual(shingler.normalized_tokens(u'c a'), [u'c', u'a'])
+		self.assertEqual(stats.counters['normalization_cache_misses'], 2)
+
+	def test_parallel_build_rejected(self):
+		with self.assertRaises(ValueError):
+			build_shingle_table_parallel(self._get_doc_records(), self._get_shingler(), processes = 1)
+
+class HashShingleTest(CommonSequenceGeneratorTest):
+
+	def _build_shingle_table(self):
+		shingler = self._get_shingler()
+		self._shingle_table = ShingleTable(shingler.shingle_docs(self._get_doc_records()), shingler = shingler)
+
+	def _get_shingler(self):
+		return Shingler(shingle_size = self.shingle_size, normalization_fn = BasicNormalizer().normalize,
+		                token_ptrn = r"(?u)\b\w+\b", shingle_key = SHINGLE_KEY_HASH, keep_tokens = True)
+
+	def test_rolling_hash(self):
+		shingler = self._shingle_table.shingler
+		for doc_id, tokens in shingler.doc_tokens.iteritems():
+			expected = []
+			for i in xrange(len(tokens) - self.shingle_size + 1):
+				expected.append(reduce(lambda h, token: (h * HASH_BASE + (hash(token) & HASH_MASK)) & HASH_MASK, tokens[i:i+self.shingle_size], 0))
+			self.assertEqual([record.shingle for record in shingler.shingle_tokens(doc_id, tokens)], expected)
+
+	def test_verify_shingles(self):
+		# every shingle collides: unverified runs are garbage, verified runs are the true matches
+		shingler = self._get_shingler()
+		shingler._hash_shingles = lambda tokens: [0] * max(0, len(tokens) - self.shingle_size + 1)
+		shingle_table = ShingleTable(shingler.shingle_docs(self._get_doc_records()), shingler = shingler)
+
+		spans = lambda csg, doc_id: [group.span for group in csg.generate_common_sequences(doc_id)]
+		self.assertNotEqual(spans(CommonSequenceGenerator(shingle_table), 1), [(2,5)])
+
+		csg = CommonSequenceGenerator(shingle_table, verify_shingles = True)
+		self.assertEqual([spans(csg, doc_id) for doc_id in self.doc_ids], [[], [(2,5)], [(5,8)]])
+		self.assertEqual([(seq.src_doc_id, seq.src_position, seq.target_position, seq.length) for seq in csg.generate_all_common_sequences()], 
+		                 [(1, 2, 5, 3)])
+
+	def test_verify_non_overlapping_self_matches(self):
+		# with every shingle colliding, the offset 7 diagonal of doc 0 is one run of 12 shingles; 
+		# only its true 'a b c' repeat, which straddles the first non overlapping split, survives
+		shingler = Shingler(shingle_size = 2, normalization_fn = BasicNormalizer().normalize,
+		                    token_ptrn = r"(?u)\b\w+\b", shingle_key = SHINGLE_KEY_HASH, keep_tokens = True)
+		shingler._hash_shingles = lambda tokens: [0] * max(0, len(tokens) - 1)
+		doc = DocRecord(0, u'd e f g h a b c i j k l a b c m n o p q')
+		shingle_table = ShingleTable(shingler.shingle_docs([doc]), shingler = shingler)
+
+		csg = CommonSequenceGenerator(shingle_table, self_match_policy = SELF_MATCH_NON_OVERLAPPING, verify_shingles = True)
+		sequences = [seq for group in csg.generate_common_sequences(0) for seq in group.sequences]
+		self.assertEqual(sorted( (seq.src_position, seq.target_position, seq.length) for seq in sequences ), [(5,12,2), (12,5,2)])
+
+	def test_verify_shingles_requires_tokens(self):
+		with self.assertRaises(ValueError):
+			CommonSequenceGenerator(ShingleTable(self._get_shingles()), verify_shingles = True)
+
+	def test_save_rejected(self):
+		table_dir = tempfile.mkdtemp()
+		try:
+			self.assertRaises(ValueError, self._shingle_table.save, table_dir)
+			self.assertRaises(ValueError, ShingleTable(self._get_shingles()).save, table_dir)
+			self.assertRaises(ValueError, build_table_on_disk, self._get_shingles(), table_dir, shingler = self._get_shingler())
+			self.assertRaises(ValueError, build_table_on_disk, self._get_shingles(), table_dir)
+		finally:
+			shutil.rmtree(table_dir)
+
+class GeneratorPruningTest(unittest.TestCase):
+
+	# shingle size 2:  doc 0 / doc 1 share "a b c" (2 shingles) and "d e" (1 shingle),
+	#                  doc 0 / doc 2 share "a b c d e f" (5 shingles)
+
+	def setUp(self):
+		shingler = Shingler(shingle_size = 2, normalization_fn = BasicNormalizer().normalize, token_ptrn = r"(?u)\b\w+\b")
+		docs = map(DocRecord, [0, 1, 2], [u'a b c d e f', u'a b c x y z d e', u'q a b c d e f'])
+		self._shingle_table = ShingleTable(shingler.shingle_docs(docs))
+
+	def _spans(self, doc_id, **kwargs):
+		csg = CommonSequenceGenerator(self._shingle_table, **kwargs)
+		return [group.span for group in csg.generate_common_sequences(doc_id)]
+
+	def test_min_length(self):
+		self.assertEqual(self._spans(1), [(0,2), (6,7)])
+		self.assertEqual(self._spans(1, min_length = 2), [(0,2)])
+		self.assertEqual(self._spans(1, min_length = 3), [])
+
+		csg = CommonSequenceGenerator(self._shingle_table, min_length = 2)
+		lengths = sorted( (seq.src_doc_id, seq.target_doc_id, seq.length) for seq in csg.generate_all_common_sequences() )
+		self.assertEqual(lengths, [(0, 1, 2), (0, 2, 5), (1, 2, 2)])
+
+	def test_all_pairs_probes_each_pair_once(self):
+		stats = Stats()
+		csg = CommonSequenceGenerator(self._shingle_table, stats = stats)
+		lengths = sorted( (seq.src_doc_id, seq.target_doc_id, seq.length) for seq in csg.generate_all_common_sequences() )
+		self.assertEqual(lengths, [(0, 1, 1), (0, 1, 2), (0, 2, 5), (1, 2, 1), (1, 2, 2)])
+		n_pairs = sum(len(bucket) * (len(bucket) - 1) // 2 for bucket in self._shingle_table.itervalues())
+		self.assertEqual(stats.counters['postings_probed'], n_pairs)
+
+	def test_max_targets_per_group(self):
+		csg = CommonSequenceGenerator(self._shingle_table, max_targets_per_group = 1)
+		groups = csg.generate_common_sequences(0)
+		self.assertEqual(max(group.length for group in groups), 5)
+		targets = set( (seq.target_doc_id, seq.length) for group in groups for seq in group.sequences if group.length == 5 )
+		self.assertEqual(targets, set([(2, 5)]))
+
+	def test_top_k(self):
+		self.assertEqual(self._spans(1, top_k = 1), [(0,2)])
+		self.assertEqual(self._spans(1, top_k = 5), [(0,2), (6,7)])
+
+	def test_invalid_parameters(self):
+		for kwargs in ({'min_length': 0}, {'max_targets_per_group': 0}, {'top_k': 0}):
+			with self.assertRaises(ValueError):
+				CommonSequenceGenerator(self._shingle_table, **kwargs)
+
+class LazyGenerationTest(unittest.TestCase):
+
+	# shingle size 2:  doc 0 shares "a b c d e f" with doc 2 and "h i j k l m n o" with doc 3,
+	#                  and "a b" again at its end with docs 1 and 2
+
+	def setUp(self):
+		shingler = Shingler(shingle_size = 2, normalization_fn = BasicNormalizer().normalize, token_ptrn = r"(?u)\b\w+\b")
+		docs = map(DocRecord, [0, 1, 2, 3], [u'a b c d e f g h i j k l m n o p a b', u'a b c', u'q a b c d e f', u'h i j k l m n o'])
+		self._shingle_table = ShingleTable(shingler.shingle_docs(docs))
+
+	def test_matches_generate_common_sequences(self):
+		for kwargs in ({}, {'min_length': 2}):
+			csg = CommonSequenceGenerator(self._shingle_table, **kwargs)
+			for doc_id in xrange(4):
+				expected = SequenceGroup.group_sequences(sorted( (seq for group in csg.generate_common_sequences(doc_id) for seq in group.sequences), 
+				                                                 key = lambda seq: (seq.src_position, -seq.length) ))
+				lazy_groups = list(csg.iter_common_sequences(doc_id))
+				self.assertEqual([group.span for group in lazy_groups], [group.span for group in expected])
+				self.assertEqual([group.sequences for group in lazy_groups], [group.sequences for group in expected])
+
+	def test_groups_yielded_early(self):
+		csg = CommonSequenceGenerator(self._shingle_table)
+		consumed = []
+		table_postings = csg._table_postings
+		csg._table_postings = lambda src_shingles: ( consumed.append(position) or (position, postings) for position, postings in table_postings(src_shingles) )
+
+		groups = csg.iter_common_sequences(0)
+		self.assertEqual(next(groups).span, (0,5))
+		self.assertLess(max(consumed), 16)
+		self.assertEqual([group.span for group in groups], [(7,14), (16,17)])
+
+	def test_top_k_unsupported(self):
+		with self.assertRaises(ValueError):
+			next(CommonSequenceGenerator(self._shingle_table, top_k = 1).iter_common_sequences(0))
+
+class StatsTest(unittest.TestCase):
+
+	def setUp(self):
+		self._stages = []
+		self._stats = Stats(on_stage = lambda stage, seconds: self._stages.append(stage))
+		shingler = Shingler(shingle_size = SHINGLE_SIZE, normalization_fn = BasicNormalizer().normalize,
+		                    token_ptrn = r"(?u)\b\w+\b", stats = self._stats)
+		self._shingle_table = ShingleTable(shingler.shingle_docs(get_doc_records()), stats = self._stats)
+
+	def test_build_stats(self):
+		counters = self._stats.counters
+		self.assertEqual(counters['docs_shingled'], 3)
+		self.assertEqual(counters['shingles'], counters['shingles_added'])
+		self.assertEqual(counters['shingles_added'], len(list(get_shingles())))
+		self.assertEqual(counters['singletons_purged'], self._shingle_table.build_stats['n_purged_uniques'])
+		self.assertEqual(counters['shared_shingles'], len(self._shingle_table))
+		self.assertEqual(sum(self._stats.histograms['bucket_size'].values()), len(self._shingle_table))
+		self.assertEqual(self._stats.histograms['bucket_size'], {2: 3})
+		self.assertEqual(set(self._stages), set(['tokenize', 'table_add', 'table_purge']))
+
+	def test_generator_stats(self):
+		csg = CommonSequenceGenerator(self._shingle_table, stats = self._stats)
+		csg.generate_common_sequences(1)
+
+		counters = self._stats.counters
+		self.assertEqual(counters['source_positions'], 3)
+		self.assertEqual(counters['postings_probed'], 6)
+		self.assertEqual(counters['runs_opened'], 1)
+		self.assertEqual(counters['runs_closed'], 1)
+		self.assertEqual(counters['sequences_emitted'], 1)
+		self.assertEqual(counters['groups'], 1)
+		self.assertEqual(self._stats.maxima['max_active_runs'], 1)
+		self.assertTrue(set(['invert', 'load_inversion', 'sweep', 'group']) <= set(self._stats.timings))
+		self.assertEqual(self._stages.count('invert'), 1)
+
+		gapped_stats = Stats()
+		CommonSequenceGenerator(self._shingle_table, max_gap = 2, stats = gapped_stats).generate_common_sequences(1)
+		self.assertEqual(gapped_stats.counters['runs_opened'], 1)
+		self.assertEqual(gapped_stats.counters['runs_closed'], 1)
+
+class InversionCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self._shingle_table = ShingleTable(get_shingles())
+
+	def test_inversion_memoized(self):
+		inverted = self._shingle_table.invert()
+		self.assertIs(self._shingle_table.invert(), inverted)
+		self.assertIs(CommonSequenceGenerator(self._shingle_table)._inverted_shingle_table, inverted)
+		for doc_id, inv_bucket in inverted.iteritems():
+			self.assertEqual(inv_bucket, sorted(inv_bucket, key = lambda (shingle, i): i))
+
+		compact_shingle_table = CompactShingleTable(get_shingles())
+		self.assertIs(compact_shingle_table.invert(), compact_shingle_table.invert())
+
+	def test_invalidated_by_changes(self):
+		shingle = next(iter(self._shingle_table))
+		bucket = self._shingle_table[shingle]
+		expected = ShingleTable(get_shingles()).invert()
+
+		mutations = [
+			lambda table: table.pop(shingle),
+			lambda table: table.update({shingle: set([(0, 0), (1, 0)])}),
+			lambda table: table.__setitem__(shingle, set([(0, 1), (2, 7)])),
+			lambda table: table.__delitem__(shingle),
+			lambda table: table.setdefault(shingle, set(bucket)),
+		]
+		for mutate in mutations:
+			self._shingle_table.invert()
+			mutate(self._shingle_table)
+			self.assertEqual(self._shingle_table.invert(), ShingleTable(self._shingle_table._records(), purge_uniques = False).invert())
+
+		self.assertEqual(self._shingle_table.invert(), expected)
+		self._shingle_table[shingle].add( (0, 0) )
+		self._shingle_table.invalidate_inversion()
+		self.assertIn( (shingle, 0), self._shingle_table.invert()[0] )
+
+	def test_not_pickled(self):
+		self._shingle_table.invert()
+		unpickled = pickle.loads(pickle.dumps(self._shingle_table, pickle.HIGHEST_PROTOCOL))
+		self.assertIsNone(unpickled._inverted_cache)
+		self.assertEqual(unpickled.invert(), self._shingle_table.invert())
+
+class MinHashLSHTest(unittest.TestCase):
+
+	def setUp(self):
+		self._shingle_table = ShingleTable(get_shingles())
+
+	def test_jaccard_estimate(self):
+		minhasher = MinHasher(num_perm = 256)
+		signature = minhasher.signature(u'w{0}'.format(i) for i in xrange(100))
+		self.assertEqual(estimate_jaccard(signature, minhasher.signature(u'w{0}'.format(i) for i in reversed(xrange(100)))), 1.0)
+		estimate = estimate_jaccard(signature, minhasher.signature(u'w{0}'.format(i) for i in xrange(50, 150)))
+		self.assertAlmostEqual(estimate, 1 / 3.0, delta = 0.1)
+		self.assertEqual(estimate_jaccard(signature, minhasher.signature(u'v{0}'.format(i) for i in xrange(100))), 0.0)
+
+	def test_candidates(self):
+		# one row per band: any agreeing permutation makes a candidate
+		index = build_lsh_index(get_shingles(), num_perm = 64, bands = 64)
+		self.assertEqual(len(index), 3)
+		self.assertEqual(index.candidates(0), set())
+		self.assertEqual(index.candidates(1), set([2]))
+		self.assertEqual([(doc_id, other_doc_id) for doc_id, other_doc_id, jaccard in index.candidate_pairs()], [(1, 2)])
+		self.assertEqual(list(index.candidate_pairs(min_jaccard = 0.9)), [])
+
+		with self.assertRaises(ValueError):
+			LSHIndex(num_perm = 64, bands = 10)
+		with self.assertRaises(ValueError):
+			index.add(0, index.signatures[0])
+
+	def test_restricted_targets(self):
+		csg = CommonSequenceGenerator(self._shingle_table)
+		index = build_lsh_index(get_shingles(), num_perm = 64, bands = 64)
+		self.assertEqual([group.span for group in csg.generate_common_sequences(1, target_doc_ids = index.candidates(1))], [(2,5)])
+		self.assertEqual(csg.generate_common_sequences(1, target_doc_ids = [0]), [])
+		self.assertEqual(list(csg.iter_common_sequences(2, target_doc_ids = [])), [])
+
+class SpanRecoveryTest(unittest.TestCase):
+
+	quote = u'should nearly match another document that I will write below'
+
+	def setUp(self):
+		self._shingler = Shingler(shingle_size = SHINGLE_SIZE, normalization_fn = BasicNormalizer().normalize,
+		                          token_ptrn = r"(?u)\b\w+\b", record_offsets = True)
+		self._shingle_table = ShingleTable(self._shingler.shingle_docs(get_doc_records()))
+
+	def test_token_offsets(self):
+		normalize = BasicNormalizer().normalize
+		for doc_record in get_doc_records():
+			offsets = self._shingler.token_offsets[doc_record.doc_id]
+			tokens = [normalize(doc_record.doc[offsets[k]:offsets[k + 1]]) for k in xrange(0, len(offsets), 2)]
+			self.assertEqual(tokens, self._shingler.normalized_tokens(doc_record.doc))
+
+	def test_sequence_text(self):
+		texts = dict( (doc_record.doc_id, doc_record.doc) for doc_record in get_doc_records() )
+		resolver = SpanResolver(self._shingler.token_offsets, SHINGLE_SIZE, texts)
+		[group] = CommonSequenceGenerator(self._shingle_table).generate_common_sequences(1)
+		[sequence] = group.sequences
+
+		self.assertEqual(resolver.source_text(sequence), self.quote)
+		self.assertEqual(resolver.target_text(sequence), self.quote)
+		self.assertEqual(resolver.group_text(group), self.quote)
+		self.assertEqual(resolver.group_span(group), resolver.source_span(sequence))
+
+	def test_mapped_texts(self):
+		texts_dir = tempfile.mkdtemp()
+		try:
+			doc_records = get_doc_records() + [DocRecord(3, u'caf\xe9 \u2603 \U0001f600 end')]
+			write_texts(texts_dir, doc_records)
+			texts = MappedTexts(texts_dir)
+			self.assertEqual(len(texts), 4)
+			self.assertEqual([texts[doc_record.doc_id] for doc_record in doc_records], [unicode(doc_record.doc) for doc_record in doc_records])
+			self.assertEqual(texts.text(3, 5, 6), u'\u2603')
+			self.assertEqual(texts.text(3, 20, 30), u'')
+
+			resolver = SpanResolver(self._shingler.token_offsets, SHINGLE_SIZE, texts)
+			[group] = CommonSequenceGenerator(self._shingle_table).generate_common_sequences(2)
+			self.assertEqual(resolver.group_text(group), self.quote)
+			texts.close()
+		finally:
+			shutil.rmtree(texts_dir)
+
+
+class GappedExtensionTest(unittest.TestCase):
+
+	# shingle size 2:  doc 1 is doc 0 with "e" replaced by "x", which breaks the shingles at 3 and 4
+
+	def setUp(self):
+		shingler = Shingler(shingle_size = 2, normalization_fn = BasicNormalizer().normalize, token_ptrn = r"(?u)\b\w+\b")
+		docs = map(DocRecord, [0, 1, 2], [u'a b c d e f g h i j', u'a b c d x f g h i j', u'q r s a b c'])
+		self._shingle_table = ShingleTable(shingler.shingle_docs(docs))
+
+	def _spans(self, doc_id, **kwargs):
+		csg = CommonSequenceGenerator(self._shingle_table, **kwargs)
+		return [group.span for group in csg.generate_common_sequences(doc_id)]
+
+	def test_substitution_bridged(self):
+		self.assertEqual(self._spans(1), [(0,3), (5,9)])
+		self.assertEqual(self._spans(1, max_gap = 1), [(0,3), (5,9)])
+		self.assertEqual(self._spans(1, max_gap = 2), [(0,9)])
+
+		csg = CommonSequenceGenerator(self._shingle_table, max_gap = 2)
+		lengths = sorted( (seq.target_doc_id, seq.target_position, seq.length) for group in csg.generate_common_sequences(0) for seq in group.sequences )
+		self.assertEqual(lengths, [(1, 0, 9), (2, 3, 2)])
+
+	def test_indels_bridged(self):
+		# doc 1 inserts "z" into doc 0, doc 2 inserts "y z": the shifted runs continue when both 
+		# gaps (shingle_size - 1 + number of inserted tokens) are within max_gap
+		shingler = Shingler(shingle_size = 2, normalization_fn = BasicNormalizer().normalize, token_ptrn = r"(?u)\b\w+\b")
+		docs = map(DocRecord, [0, 1, 2], [u'a b c d e f g h i j', u'a b c d z e f g h i j', u'q a b c d y z e f g h i j'])
+		shingle_table = ShingleTable(shingler.shingle_docs(docs), shingler = shingler)
+		keys = lambda doc_id, target_doc_id, max_gap: sorted( 
+			(seq.src_position, seq.length, seq.target_position, seq.target_length) 
+			for group in CommonSequenceGenerator(shingle_table, max_gap = max_gap).generate_common_sequences(doc_id)
+			for seq in group.sequences if seq.target_doc_id == target_doc_id )
+
+		self.assertEqual(keys(0, 1, 1), [(0, 3, 0, 3), (4, 5, 5, 5)])
+		self.assertEqual(keys(0, 1, 2), [(0, 9, 0, 10)])
+		self.assertEqual(keys(1, 0, 2), [(0, 10, 0, 9)])
+		self.assertEqual(keys(0, 2, 2), [(0, 3, 1, 3), (4, 5, 7, 5)])
+		self.assertEqual(keys(0, 2, 3), [(0, 9, 1, 11)])
+
+		[seq] = [seq for seq in CommonSequenceGenerator(shingle_table, max_gap = 3).generate_all_common_sequences() 
+		         if (seq.src_doc_id, seq.target_doc_id) == (0, 2)]
+		self.assertEqual((seq.target_end_position, seq.src_end_position), (12, 9))
+		self.assertEqual(pickle.loads(pickle.dumps(seq)).target_length, 11)
+
+		csg = CommonSequenceGenerator(shingle_table, max_gap = 3)
+		for doc_id in xrange(3):
+			self.assertEqual([group.sequences for group in csg.iter_common_sequences(doc_id)],
+			                 [group.sequences for group in csg.generate_common_sequences(doc_id)])
+
+	def test_min_length_counts_gaps(self):
+		self.assertEqual(self._spans(1, min_length = 5), [])
+		self.assertEqual(self._spans(1, min_length = 5, max_gap = 2), [(0,9)])
+
+	def test_lazy_matches(self):
+		csg = CommonSequenceGenerator(self._shingle_table, max_gap = 2)
+		for doc_id in xrange(3):
+			self.assertEqual([group.span for group in csg.iter_common_sequences(doc_id)],
+			                 [group.span for group in csg.generate_common_sequences(doc_id)])
+
+	def test_zero_gap_sweep_is_exact(self):
+		csg = CommonSequenceGenerator(self._shingle_table)
+		for doc_id in xrange(3):
+			src_postings = list(csg._table_postings(csg._inverted_shingle_table[doc_id]))
+			exact = sorted(map(sequence_order, csg._sweep_diagonals(doc_id, src_postings)))
+			gapped = sorted(map(sequence_order, csg._sweep_gapped_diagonals(doc_id, src_postings)))
+			self.assertEqual(gapped, exact)
+
+	def test_invalid_parameters(self):
+		self.assertRaises(ValueError, CommonSequenceGenerator, self._shingle_table, max_gap = -1)
+		self.assertRaises(ValueError, CommonSequenceGenerator, self._shingle_table, max_gap = 1, verify_shingles = True)
+
+
+class QueryServiceTest(unittest.TestCase):
+
+	def setUp(self):
+		shingler = Shingler(shingle_size = 2, normalization_fn = BasicNormalizer().normalize, token_ptrn = r"(?u)\b\w+\b")
+		docs = map(DocRecord, [0, 1, 2, 3], [u'a b c d e f', u'a b c x y z d e', u'q a b c d e f', u'nothing shared'])
+		self._generator = CommonSequenceGenerator(ShingleTable(shingler.shingle_docs(docs), shingler = shingler))
+		self._stats = Stats()
+		self._query_service = QueryService(self._generator, processes = 2, max_batch_size = 4, stats = self._stats).start()
+
+	def tearDown(self):
+		self._query_service.close()
+
+	def _expected(self, doc_id, target_doc_ids = None):
+		return [sequence_group_as_dict(group) for group in self._generator.generate_common_sequences(doc_id, target_doc_ids)]
+
+	def test_query(self):
+		for doc_id in xrange(3):
+			self.assertEqual(self._query_service.query(dict(doc_id = doc_id)), self._expected(doc_id))
+		self.assertEqual(self._query_service.query(dict(doc_id = 3)), [])
+		self.assertEqual(self._query_service.query(dict(doc_id = 0, target_doc_ids = [1])), self._expected(0, [1]))
+
+		[group] = self._query_service.query(dict(doc = u'z a b c d'))
+		self.assertEqual(group['span'], [1, 4])
+		self.assertEqual(set(seq['target_doc_id'] for seq in group['sequences']), set([0, 1, 2]))
+		self.assertRaises(ValueError, self._query_service.submit, dict(target_doc_ids = [1]))
+
+	def test_socket_server(self):
+		server = QueryServer(self._query_service, ('127.0.0.1', 0))
+		server_thread = threading.Thread(target = server.serve_forever)
+		server_thread.daemon = True
+		server_thread.start()
+		try:
+			results = {}
+			def client(client_index):
+				with QueryClient(server.server_address) as query_client:
+					results[client_index] = [query_client.query(doc_id = doc_id) for doc_id in xrange(4)]
+			threads = [threading.Thread(target = client, args = (client_index,)) for client_index in xrange(4)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+			expected = [self._expected(doc_id) for doc_id in xrange(3)] + [[]]
+			self.assertEqual(results, dict( (client_index, expected) for client_index in xrange(4) ))
+
+			with QueryClient(server.server_address) as query_client:
+				external_groups = self._generator.find_common_sequences(DocRecord(None, u'a b c'), [0, 2])
+				self.assertEqual(query_client.query(doc = u'a b c', target_doc_ids = [0, 2]), map(sequence_group_as_dict, external_groups))
+				query_client._socket.sendall('not json\n')
+				self.assertTrue(next(query_client._responses())['error'].startswith('Invalid query'))
+				metrics = query_client.metrics()
+
+			self.assertEqual(metrics['latency']['count'], 17)
+			self.assertEqual(metrics['counters']['queries'], 17)
+			self.assertTrue(metrics['latency']['p50_ms'] <= metrics['latency']['p99_ms'])
+			self.assertTrue(max(self._stats.histograms['batch_size']) <= 4)
+
+		finally:
+			server.shutdown()
+			server.server_close()
+
+	def test_unshared_documents(self):
+		self.assertEqual([self._generator.has_shared_shingles(doc_id) for doc_id in [0, 3, 4]], [True, False, False])
+		self.assertEqual(self._query_service.query(dict(doc_id = 4)), [])
+
+		# a KeyError raised by anything else is an error, not an empty result
+		def broken_postings(src_shingles):
+			raise KeyError('shingle id')
+		self._generator._table_postings = broken_postings
+		self.assertEqual(_run_query(self._generator, dict(doc_id = 0)), (False, "KeyError: 'shingle id'"))
+		with self.assertRaises(KeyError):
+			list(generate_common_sequences_parallel(self._generator, [0], processes = 1))
+
+	def test_lost_batches_fail(self):
+		# every worker dies on its first query: its batch times out instead of hanging the clients
+		def die(*args):
+			os._exit(1)
+		self._generator.generate_common_sequences = die
+		query_service = QueryService(self._generator, processes = 1, max_pending = 1, batch_timeout = 0.2).start()
+		try:
+			for doc_id in (0, 1):
+				with self.assertRaises(ValueError) as raised:
+					query_service.query(dict(doc_id = doc_id), timeout = 5)
+				self.assertTrue('timed out after' in str(raised.exception))
+		finally:
+			query_service.close()
+
+	def test_services_independent(self):
+		# closing another service must not take the generator from this one's respawned workers
+		QueryService(self._generator, processes = 1).start().close()
+		pool = self._query_service._pool
+		pids = set(worker.pid for worker in pool._pool)
+		for _ in pids:
+			pool._inqueue.put(None)		# a worker exits on a None task and the pool replaces it
+		deadline = time.time() + 10
+		while time.time() < deadline and (len(pool._pool) < len(pids) or pids & set(worker.pid for worker in pool._pool)):
+			time.sleep(0.01)
+		self.assertFalse(pids & set(worker.pid for worker in pool._pool))
+
+		for doc_id in xrange(3):
+			self.assertEqual(self._query_service.query(dict(doc_id = doc_id), timeout = 5), self._expected(doc_id))
+
+	def test_latency_percentiles(self):
+		latencies = LatencyTracker(window = 100)
+		self.assertEqual(latencies.summary()['p50_ms'], None)
+		for ms in xrange(1, 201):
+			latencies.record(ms / 1000.0)
+		summary = latencies.summary()
+		self.assertEqual(summary['count'], 200)
+		self.assertAlmostEqual(summary['p50_ms'], 150)
+		self.assertAlmostEqual(summary['p99_ms'], 199)
+		self.assertAlmostEqual(summary['max_ms'], 200)
+
 
 if __name__ == '__main__':
 
@@ -315,8 +1291,11 @@ if __name__ == '__main__':
 					OneBigGroupTest,
 					SingletonGroupTest,
 					SeriesOfSingletonsGroupsTest,
+					UnorderedGroupTest,
+					ChainedOverlapGroupTest,
+					SequenceGroupIndexTest,
 				 ]
-	common_sequence_generator_test_cases = [CommonSequenceGeneratorTest]
+	common_sequence_generator_test_cases = [CommonSequenceGeneratorTest, CompactShingleTableTest, TwoPassShingleTableTest, ParallelShingleTableTest, MappedShingleTableTest, SelfMatchPolicyTest, StopShingleTest, IncrementalShingleTableTest, ExternalQueryTest, ExternalSortTableTest, ShinglerFastPathTest, HashShingleTest, GeneratorPruningTest, LazyGenerationTest, StatsTest, InversionCacheTest, MinHashLSHTest, SpanRecoveryTest, GappedExtensionTest, QueryServiceTest]
 
 
 	sequence_test_suite = test_suite_from_test_cases(sequence_test_cases)